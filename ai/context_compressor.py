@@ -3,156 +3,224 @@
 """
 
 import re
+import heapq
 import logging
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
 from typing import List, Dict, Tuple
-from dataclasses import dataclass
+
+from .token_manager import get_encoding
 
 logger = logging.getLogger(__name__)
 
-@dataclass
-class Message:
-    """Структура сообщения"""
-    text: str
-    importance: float
-    timestamp: str = ""
-    user_id: int = 0
+@lru_cache(maxsize=4096)
+def _encoded_length(encoding, text: str) -> int:
+    """Количество BPE-токенов (кэшируется для повторяющихся сообщений)"""
+    return len(encoding.encode(text, disallowed_special=()))
+
+def _bounded_join(parts: List[str], limit: int, sep: str = ' ') -> str:
+    """Аналог sep.join(parts)[:limit] без построения полной строки"""
+    pieces = []
+    remaining = limit
+    for part in parts:
+        if remaining <= 0:
+            break
+        if pieces:
+            pieces.append(sep[:remaining])
+            remaining -= len(sep)
+            if remaining <= 0:
+                break
+        piece = part[:remaining]
+        pieces.append(piece)
+        remaining -= len(piece)
+    return ''.join(pieces)
 
 class ContextCompressor:
     """Компрессор контекста для оптимизации диалогов"""
     
+    # Ключевые слова для определения важности
+    importance_keywords = {
+        'high': ['важно', 'проблема', 'цель', 'мечта', 'страх', 'тревога', 'кризис', 'срочно'],
+        'medium': ['работа', 'карьера', 'отношения', 'семья', 'деньги', 'здоровье'],
+        'low': ['привет', 'спасибо', 'хорошо', 'понятно', 'да', 'нет']
+    }
+    
+    # Паттерны для извлечения ключевой информации
+    key_patterns = [
+        r'я хочу (.+)',
+        r'моя цель (.+)',
+        r'моя проблема (.+)',
+        r'я боюсь (.+)',
+        r'я мечтаю (.+)',
+        r'я работаю (.+)',
+        r'я изучаю (.+)',
+        r'я планирую (.+)'
+    ]
+    
+    # Предкомпилированные структуры общие для всех экземпляров:
+    # строятся один раз при создании первого компрессора (см. _ensure_compiled)
+    _token_re = None
+    _high_kw = None
+    _medium_kw = None
+    _low_kw = None
+    _combined_key_pattern = None
+    _insight_re = None
+    
+    @classmethod
+    def _ensure_compiled(cls):
+        """Однократная компиляция регулярок и множеств ключевых слов"""
+        if cls._token_re is not None:
+            return
+        
+        cls._high_kw = frozenset(cls.importance_keywords['high'])
+        cls._medium_kw = frozenset(cls.importance_keywords['medium'])
+        cls._low_kw = frozenset(cls.importance_keywords['low'])
+        # Каждый паттерн обернут в lookahead, чтобы один проход finditer
+        # находил все паттерны, даже если их совпадения перекрываются
+        cls._combined_key_pattern = re.compile('|'.join(
+            f'(?=(?P<p{i}>{pattern}))' for i, pattern in enumerate(cls.key_patterns)
+        ))
+        
+        # Категории инсайтов: одна регулярка с именованной группой на категорию
+        cls._insight_re = re.compile(
+            r'(?P<goals>хочу|мечтаю|цель|планирую)|'
+            r'(?P<problems>проблема|трудно|сложно|не получается)|'
+            r'(?P<fears>боюсь|страшно|тревожно|волнуюсь)|'
+            r'(?P<interests>интересно|нравится|люблю|увлекаюсь)',
+            re.IGNORECASE
+        )
+        # Флаг готовности присваивается последним
+        cls._token_re = re.compile(r'\w+')
+    
     def __init__(self, config):
         self.config = config
         
-        # Ключевые слова для определения важности
-        self.importance_keywords = {
-            'high': ['важно', 'проблема', 'цель', 'мечта', 'страх', 'тревога', 'кризис', 'срочно'],
-            'medium': ['работа', 'карьера', 'отношения', 'семья', 'деньги', 'здоровье'],
-            'low': ['привет', 'спасибо', 'хорошо', 'понятно', 'да', 'нет']
-        }
+        # Общий на процесс энкодер tiktoken для точного подсчета токенов
+        self.encoding = get_encoding("cl100k_base")
+        
+        self._ensure_compiled()
         
-        # Паттерны для извлечения ключевой информации
-        self.key_patterns = [
-            r'я хочу (.+)',
-            r'моя цель (.+)',
-            r'моя проблема (.+)',
-            r'я боюсь (.+)',
-            r'я мечтаю (.+)',
-            r'я работаю (.+)',
-            r'я изучаю (.+)',
-            r'я планирую (.+)'
-        ]
+        # Кэш анализа содержимого сообщений: на каждом ходу диалога заново
+        # анализируется только новое сообщение, остальные берутся из кэша
+        cache_size = getattr(config, 'cache_size', 1000)
+        self._message_stats = lru_cache(maxsize=cache_size)(self._compute_message_stats)
+        self._message_categories = lru_cache(maxsize=cache_size)(self._compute_message_categories)
     
     def compress_conversation(self, messages: List[str], max_tokens: int) -> str:
         """Сжатие диалога с сохранением важной информации"""
         if not messages:
             return ""
         
-        # Анализируем важность каждого сообщения
-        analyzed_messages = self._analyze_messages(messages)
+        # Анализируем важность и считаем токены за один проход.
+        # Данные хранятся параллельными списками: messages[i], importances[i], tokens[i]
+        importances, tokens, total_tokens = self._analyze_messages(messages)
         
         # Если все помещается, возвращаем как есть
-        total_tokens = sum(self._count_tokens(msg.text) for msg in analyzed_messages)
         if total_tokens <= max_tokens:
-            return self._format_messages(analyzed_messages)
+            return self._format_messages(messages)
         
-        # Приоритизируем сообщения
-        prioritized = self._prioritize_messages(analyzed_messages)
+        # Приоритизируем сообщения (индексы по убыванию важности)
+        order = self._prioritize_messages(importances, tokens, max_tokens)
         
         # Выбираем сообщения, которые помещаются в лимит
-        selected_messages = self._select_messages(prioritized, max_tokens)
+        selected_messages = self._select_messages(order, messages, tokens, max_tokens)
         
         # Создаем сжатый контекст
-        compressed = self._create_compressed_context(selected_messages, analyzed_messages)
+        compressed = self._create_compressed_context(selected_messages, len(messages))
         
         return compressed
     
-    def _analyze_messages(self, messages: List[str]) -> List[Message]:
-        """Анализ важности сообщений"""
-        analyzed = []
+    def _analyze_messages(self, messages: List[str]) -> Tuple[List[float], List[int], int]:
+        """Анализ важности сообщений и подсчет токенов (параллельные списки)"""
+        total = len(messages)
+        importances = [0.0] * total
+        tokens = [0] * total
+        total_tokens = 0
+        message_stats = self._message_stats
         
         for i, text in enumerate(messages):
-            importance = self._calculate_importance(text, i, len(messages))
-            analyzed.append(Message(
-                text=text,
-                importance=importance,
-                timestamp=f"msg_{i+1}"
-            ))
-        
-        return analyzed
+            content_importance, message_tokens = message_stats(text)
+            # Вес позиции (последние сообщения важнее) плюс вес содержимого
+            importances[i] = min((i + 1) / total * 0.3 + content_importance, 1.0)
+            tokens[i] = message_tokens
+            total_tokens += message_tokens
+        
+        return importances, tokens, total_tokens
     
     def _calculate_importance(self, text: str, position: int, total: int) -> float:
         """Расчет важности сообщения"""
-        importance = 0.0
-        text_lower = text.lower()
-        
+        return self._position_importance(position, total, self._message_stats(text)[0])
+    
+    def _position_importance(self, position: int, total: int, content_importance: float) -> float:
+        """Итоговая важность: вес позиции плюс вес содержимого"""
         # Базовый вес на основе позиции (последние сообщения важнее)
         position_weight = (position + 1) / total
-        importance += position_weight * 0.3
-        
-        # Вес на основе ключевых слов
-        for level, keywords in self.importance_keywords.items():
-            weight = {'high': 0.5, 'medium': 0.3, 'low': 0.1}[level]
-            keyword_count = sum(1 for keyword in keywords if keyword in text_lower)
-            importance += keyword_count * weight
-        
-        # Вес на основе длины (более длинные сообщения обычно важнее)
-        length_weight = min(len(text) / 200, 1.0) * 0.2
-        importance += length_weight
-        
-        # Вес на основе паттернов
-        pattern_weight = self._check_key_patterns(text_lower) * 0.3
-        importance += pattern_weight
-        
-        return min(importance, 1.0)
+        return min(position_weight * 0.3 + content_importance, 1.0)
+    
+    def _compute_message_stats(self, text: str) -> Tuple[float, int]:
+        """Вес содержимого и число токенов сообщения (не зависят от позиции)"""
+        return self._content_importance(text), self._count_tokens(text)
+    
+    def _content_importance(self, text: str) -> float:
+        """Вес содержимого сообщения: ключевые слова, длина, паттерны"""
+        text_lower = text.lower()
+        words = set(self._token_re.findall(text_lower))
+        
+        # Ключевые слова (пересечение множеств), длина (более длинные сообщения
+        # обычно важнее) и паттерны - одним выражением без промежуточных словарей
+        return (
+            len(words & self._high_kw) * 0.5
+            + len(words & self._medium_kw) * 0.3
+            + len(words & self._low_kw) * 0.1
+            + min(len(text) / 200, 1.0) * 0.2
+            + self._check_key_patterns(text_lower) * 0.3
+        )
     
     def _check_key_patterns(self, text: str) -> float:
         """Проверка ключевых паттернов в тексте"""
-        pattern_matches = 0
-        for pattern in self.key_patterns:
-            if re.search(pattern, text):
-                pattern_matches += 1
+        # Считаем различные сработавшие паттерны за один проход
+        pattern_matches = len({
+            match.lastgroup for match in self._combined_key_pattern.finditer(text)
+        })
         
         return min(pattern_matches / len(self.key_patterns), 1.0)
     
-    def _prioritize_messages(self, messages: List[Message]) -> List[Message]:
-        """Приоритизация сообщений по важности"""
-        # Сортируем по важности (убывание)
-        return sorted(messages, key=lambda x: x.importance, reverse=True)
+    def _prioritize_messages(self, importances: List[float], tokens: List[int], max_tokens: int) -> List[int]:
+        """Приоритизация сообщений по важности: индексы по убыванию"""
+        # В лимит поместится не больше max_tokens // min_tokens целых сообщений
+        # плюс одно частичное, поэтому полная сортировка не нужна
+        min_tokens = max(min(tokens), 1)
+        limit = min(len(importances), max_tokens // min_tokens + 1)
+        
+        # Берем самые важные (порядок равных сохраняется как у sorted)
+        return heapq.nlargest(limit, range(len(importances)), key=importances.__getitem__)
     
-    def _select_messages(self, prioritized: List[Message], max_tokens: int) -> List[Message]:
+    def _select_messages(self, order: List[int], messages: List[str], tokens: List[int], max_tokens: int) -> List[str]:
         """Выбор сообщений, которые помещаются в лимит токенов"""
-        selected = []
-        current_tokens = 0
-        
-        for message in prioritized:
-            message_tokens = self._count_tokens(message.text)
-            
-            if current_tokens + message_tokens <= max_tokens:
-                selected.append(message)
-                current_tokens += message_tokens
-            else:
-                # Если не помещается полностью, берем часть
-                remaining_tokens = max_tokens - current_tokens
-                if remaining_tokens > 50:  # Минимум 50 токенов для частичного сообщения
-                    partial_text = self._truncate_text(message.text, remaining_tokens)
-                    selected.append(Message(
-                        text=partial_text + "...",
-                        importance=message.importance,
-                        timestamp=message.timestamp
-                    ))
-                break
+        # Накопленные суммы токенов в порядке важности; граница - бинарный поиск
+        cumulative = list(accumulate(tokens[i] for i in order))
+        fit_count = bisect_right(cumulative, max_tokens)
+        selected = [messages[i] for i in order[:fit_count]]
+        
+        if fit_count < len(order):
+            # Если следующее не помещается полностью, берем часть
+            remaining_tokens = max_tokens - (cumulative[fit_count - 1] if fit_count else 0)
+            if remaining_tokens > 50:  # Минимум 50 токенов для частичного сообщения
+                partial_text = self._truncate_text(messages[order[fit_count]], remaining_tokens)
+                selected.append(partial_text + "...")
         
         return selected
     
-    def _create_compressed_context(self, selected: List[Message], all_messages: List[Message]) -> str:
+    def _create_compressed_context(self, selected: List[str], total_messages: int) -> str:
         """Создание сжатого контекста"""
         if not selected:
             return "Контекст недоступен"
         
         # Если выбраны не все сообщения, добавляем префикс
-        if len(selected) < len(all_messages):
+        if len(selected) < total_messages:
             context_parts = [
-                f"[Сжатый контекст из {len(all_messages)} сообщений]",
+                f"[Сжатый контекст из {total_messages} сообщений]",
                 ""
             ]
         else:
@@ -160,76 +228,75 @@ class ContextCompressor:
         
         # Добавляем выбранные сообщения
         for message in selected:
-            context_parts.append(f"Сообщение: {message.text}")
+            context_parts.append(f"Сообщение: {message}")
         
         return "\n".join(context_parts)
     
-    def _format_messages(self, messages: List[Message]) -> str:
+    def _format_messages(self, messages: List[str]) -> str:
         """Форматирование сообщений для контекста"""
         formatted = []
         for i, message in enumerate(messages, 1):
-            formatted.append(f"Сообщение {i}: {message.text}")
+            formatted.append(f"Сообщение {i}: {message}")
         
         return "\n".join(formatted)
     
     def _count_tokens(self, text: str) -> int:
-        """Примерный подсчет токенов (1 токен ≈ 4 символа)"""
-        return len(text) // 4
+        """Подсчет токенов через tiktoken (fallback: 1 токен ≈ 4 символа)"""
+        if self.encoding is None:
+            return len(text) // 4
+        return _encoded_length(self.encoding, text)
     
     def _truncate_text(self, text: str, max_tokens: int) -> str:
         """Обрезка текста до указанного количества токенов"""
+        if self.encoding is not None:
+            # Точная обрезка по границе токенов за один вызов encode/decode
+            token_ids = self.encoding.encode(text, disallowed_special=())
+            if len(token_ids) <= max_tokens:
+                return text
+            # Срез может разрезать многобайтовый символ - убираем символ замены
+            return self.encoding.decode(token_ids[:max_tokens]).rstrip('\ufffd')
+        
         max_chars = max_tokens * 4  # Примерное соотношение
         if len(text) <= max_chars:
             return text
         
-        # Обрезаем по словам
-        words = text.split()
-        truncated_words = []
-        current_length = 0
-        
-        for word in words:
-            if current_length + len(word) + 1 <= max_chars:
-                truncated_words.append(word)
-                current_length += len(word) + 1
-            else:
-                break
+        # Обрезаем по границе слова: срез строки вместо цикла по словам
+        truncated = text[:max_chars]
+        if not text[max_chars].isspace():
+            head = truncated.rsplit(maxsplit=1)
+            truncated = head[0] if len(head) > 1 else ""
         
-        return " ".join(truncated_words)
+        return truncated.rstrip()
     
     def extract_key_insights(self, messages: List[str]) -> Dict[str, List[str]]:
         """Извлечение ключевых инсайтов из диалога"""
-        insights = {
-            'goals': [],
-            'problems': [],
-            'fears': [],
-            'interests': [],
-            'context': []
+        goals, problems, fears, interests = [], [], [], []
+        appenders = {
+            'goals': goals.append,
+            'problems': problems.append,
+            'fears': fears.append,
+            'interests': interests.append
         }
         
+        message_categories = self._message_categories
         for message in messages:
-            text_lower = message.lower()
-            
-            # Цели и мечты
-            if any(word in text_lower for word in ['хочу', 'мечтаю', 'цель', 'планирую']):
-                insights['goals'].append(message)
-            
-            # Проблемы
-            if any(word in text_lower for word in ['проблема', 'трудно', 'сложно', 'не получается']):
-                insights['problems'].append(message)
-            
-            # Страхи
-            if any(word in text_lower for word in ['боюсь', 'страшно', 'тревожно', 'волнуюсь']):
-                insights['fears'].append(message)
-            
-            # Интересы
-            if any(word in text_lower for word in ['интересно', 'нравится', 'люблю', 'увлекаюсь']):
-                insights['interests'].append(message)
-            
-            # Общий контекст
-            if len(message) > 50:  # Более развернутые сообщения
-                insights['context'].append(message)
-        
-        return insights
+            # Цели, проблемы, страхи и интересы (результат кэшируется по тексту)
+            for category in message_categories(message):
+                appenders[category](message)
+        
+        return {
+            'goals': goals,
+            'problems': problems,
+            'fears': fears,
+            'interests': interests,
+            # Общий контекст - более развернутые сообщения
+            'context': [message for message in messages if len(message) > 50]
+        }
+    
+    def _compute_message_categories(self, message: str) -> Tuple[str, ...]:
+        """Категории инсайтов сообщения - один проход регулярки"""
+        found = {match.lastgroup for match in self._insight_re.finditer(message)}
+        return tuple(category for category in ('goals', 'problems', 'fears', 'interests') if category in found)
     
     def create_summary(self, messages: List[str]) -> str:
         """Создание краткого резюме диалога"""
@@ -252,6 +319,6 @@ class ContextCompressor:
         if not summary_parts:
             # Если нет ключевых инсайтов, берем последние сообщения
             recent_messages = messages[-3:] if len(messages) > 3 else messages
-            summary_parts.append(f"Недавний диалог: {' '.join(recent_messages)[:200]}...")
+            summary_parts.append(f"Недавний диалог: {_bounded_join(recent_messages, 200)}...")
         
         return " | ".join(summary_parts)
\ No newline at end of file
@@ -4,7 +4,11 @@
 
 import openai
 import time
+import asyncio
+import hashlib
 import logging
+from collections import OrderedDict
+from functools import partial
 from typing import Dict, Optional, Tuple, Any
 from dataclasses import dataclass
 
@@ -15,6 +19,17 @@ from .adaptive_prompt_manager import AdaptivePromptManager, PromptType
 
 logger = logging.getLogger(__name__)
 
+# TokenUsage неизменяем, поэтому пустая статистика (кэш, ошибка) - один общий объект
+_EMPTY_USAGE = TokenUsage(0, 0, 0, 0.0)
+
+# Ответы на временные ошибки API - их нельзя класть в кэш анализов
+_RATE_LIMIT_REPLY = "Извините, слишком много запросов. Попробуйте через несколько минут."
+_TIMEOUT_REPLY = "Извините, запрос занял слишком много времени. Попробуйте еще раз."
+_TRANSIENT_REPLIES = frozenset({_RATE_LIMIT_REPLY, _TIMEOUT_REPLY})
+
+# Результат анализа зависит только от типа теста и ответов, поэтому живет долго
+_ANALYSIS_CACHE_TTL = 30 * 24 * 3600
+
 @dataclass
 class AIResponse:
     """Ответ от ИИ с метаданными"""
@@ -30,7 +45,9 @@ class OpenAIClient:
     
     def __init__(self, config):
         self.config = config
-        self.client = openai.OpenAI(api_key=config.openai_api_key)
+        # Асинхронный клиент: ожидание OpenAI (десятки секунд) не блокирует цикл событий,
+        # и обновления Telegram других пользователей обрабатываются параллельно
+        self.client = openai.AsyncOpenAI(api_key=config.openai_api_key)
         
         # Инициализируем компоненты
         self.token_manager = TokenManager(config)
@@ -38,6 +55,22 @@ class OpenAIClient:
         self.token_monitor = TokenMonitor(config)
         self.prompt_manager = AdaptivePromptManager(config)
         
+        # Кэш анализов тестов: ключ -> (время сохранения, результат).
+        # Одинаковые запросы в полете делят одну задачу, чтобы не дублировать вызовы API
+        self._analysis_cache: OrderedDict = OrderedDict()
+        self._analysis_inflight: Dict[str, asyncio.Future] = {}
+        self._analysis_cache_size = getattr(config, 'cache_size', 1000)
+        self._analysis_cache_ttl = getattr(config, 'analysis_cache_ttl', _ANALYSIS_CACHE_TTL)
+        
+        # Ответы свободного диалога хранятся отдельно и недолго (cache_ttl),
+        # чтобы не вытеснять анализы тестов
+        self._dialog_cache: OrderedDict = OrderedDict()
+        self._dialog_cache_ttl = getattr(config, 'cache_ttl', 3600)
+        
+        # Запросы к API идут параллельно, но не больше заданного числа одновременно:
+        # при всплеске завершенных тестов лишние ждут слота, а не получают 429
+        self._api_slots = asyncio.Semaphore(getattr(config, 'max_concurrent_requests', 16))
+        
         # Настройки модели
         self.model_settings = {
             "gpt-4": {
@@ -52,6 +85,18 @@ class OpenAIClient:
             }
         }
     
+    async def warmup(self) -> None:
+        """Прогрев соединения с OpenAI при старте бота
+        
+        Бесплатный запрос списка моделей открывает TCP/TLS-соединение в пуле httpx,
+        и первый анализ пользователя не платит за рукопожатие.
+        """
+        try:
+            await self.client.models.list()
+            logger.info("Соединение с OpenAI установлено")
+        except Exception as e:
+            logger.warning(f"Не удалось прогреть соединение с OpenAI: {e}")
+    
     async def get_response(
         self,
         prompt: str,
@@ -77,7 +122,7 @@ class OpenAIClient:
                 logger.debug(f"Использован кэшированный ответ для пользователя {user_id}")
                 return AIResponse(
                     content=cached_response,
-                    usage=TokenUsage(0, 0, 0, 0.0),
+                    usage=_EMPTY_USAGE,
                     cached=True,
                     response_time=0.0
                 )
@@ -90,7 +135,7 @@ class OpenAIClient:
         
         # Оптимизируем промпт с учетом токенов
         optimized_prompt, optimized_context, token_usage = self.token_manager.optimize_prompt(
-            optimal_prompt, context.get('conversation', ''), "free"
+            optimal_prompt, context.get('conversation', ''), "free", query=prompt
         )
         
         # Получаем ответ от OpenAI
@@ -149,21 +194,117 @@ class OpenAIClient:
             logger.error(f"Ошибка при получении ответа от OpenAI: {e}")
             return AIResponse(
                 content="Извините, произошла ошибка при обработке запроса. Попробуйте позже.",
-                usage=TokenUsage(0, 0, 0, 0.0),
+                usage=_EMPTY_USAGE,
                 cached=False,
                 truncated=False,
                 response_time=time.time() - start_time
             )
     
-    async def get_direct_response(self, prompt: str, user_id: int) -> str:
-        """Прямой вызов OpenAI без кэша и оптимизации промптов (для анализа тестов)"""
-        return await self._call_openai(prompt, "", user_id)
+    async def get_direct_response(self, prompt: str, user_id: int,
+                                  system_prompt: Optional[str] = None,
+                                  cache_key: Optional[str] = None) -> str:
+        """Прямой вызов OpenAI без оптимизации промптов (для анализа тестов)
+        
+        system_prompt - неизменная часть инструкций: идет первой, чтобы OpenAI
+        кэшировал общий префикс запросов; cache_key группирует такие запросы.
+        С cache_key результат кэшируется по хэшу (cache_key, промпт) независимо
+        от пользователя: одинаковые ответы на тест получают готовый анализ.
+        """
+        if not cache_key:
+            return await self._call_openai(prompt, "", user_id, system_prompt)
+        
+        key = self._analysis_key(cache_key, prompt)
+        cached = self._get_cached_analysis(key)
+        if cached is not None:
+            logger.debug(f"Использован кэшированный анализ для пользователя {user_id}")
+            return cached
+        
+        task = self._analysis_inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self._call_openai(prompt, "", user_id, system_prompt, cache_key)
+            )
+            self._analysis_inflight[key] = task
+            task.add_done_callback(partial(self._store_analysis, key))
+        
+        # shield: отмена одного ожидающего не отменяет общий запрос для остальных
+        return await asyncio.shield(task)
     
-    async def _call_openai(self, prompt: str, context: str, user_id: int) -> str:
+    async def get_dialog_response(self, prompt: str, user_id: int,
+                                  system_prompt: Optional[str] = None,
+                                  cache_key: Optional[str] = None) -> str:
+        """Ответ свободного диалога
+        
+        С cache_key ответ кэшируется по хэшу (cache_key, промпт) в отдельном
+        кэше диалогов на cache_ttl секунд; без него - обычный вызов API.
+        """
+        if not cache_key:
+            return await self._call_openai(prompt, "", user_id, system_prompt)
+        
+        key = self._analysis_key(cache_key, prompt)
+        entry = self._dialog_cache.get(key)
+        if entry is not None:
+            if time.monotonic() - entry[0] < self._dialog_cache_ttl:
+                self._dialog_cache.move_to_end(key)
+                return entry[1]
+            del self._dialog_cache[key]
+        
+        result = await self._call_openai(prompt, "", user_id, system_prompt, cache_key)
+        if result and result not in _TRANSIENT_REPLIES:
+            self._dialog_cache[key] = (time.monotonic(), result)
+            if len(self._dialog_cache) > self._analysis_cache_size:
+                self._dialog_cache.popitem(last=False)
+        return result
+    
+    @staticmethod
+    def _analysis_key(cache_key: str, prompt: str) -> str:
+        """Ключ кэша анализов: хэш типа анализа и нормализованного промпта
+        
+        Регистр и пробелы не различаются: ответы, отличающиеся только ими, дают один анализ.
+        """
+        normalized = " ".join(prompt.lower().split())
+        return hashlib.sha256(f"{cache_key}|{normalized}".encode()).hexdigest()
+    
+    def _get_cached_analysis(self, key: str) -> Optional[str]:
+        """Чтение анализа из кэша с проверкой TTL"""
+        entry = self._analysis_cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self._analysis_cache_ttl:
+            del self._analysis_cache[key]
+            return None
+        self._analysis_cache.move_to_end(key)
+        return entry[1]
+    
+    def _store_analysis(self, key: str, task: asyncio.Task):
+        """Сохранение завершенного анализа в кэш (кроме ошибок)"""
+        # Удаляем только свою задачу: под ключом мог быть зарегистрирован новый запрос
+        if self._analysis_inflight.get(key) is task:
+            del self._analysis_inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._remember_analysis(key, task.result())
+    
+    def _remember_analysis(self, key: str, result: str):
+        """Запись анализа в кэш с вытеснением самого старого"""
+        if not result or result in _TRANSIENT_REPLIES:
+            return
+        
+        self._analysis_cache[key] = (time.monotonic(), result)
+        if len(self._analysis_cache) > self._analysis_cache_size:
+            self._analysis_cache.popitem(last=False)
+    
+    async def _call_openai(self, prompt: str, context: str, user_id: int,
+                           system_prompt: Optional[str] = None,
+                           cache_key: Optional[str] = None) -> str:
         """Вызов OpenAI API"""
         
         # Формируем полный промпт
         full_prompt = f"{prompt}\n\n{context}" if context else prompt
+        messages = [{"role": "user", "content": full_prompt}]
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
+        extra_body = {"prompt_cache_key": cache_key} if cache_key else None
         
         # Получаем настройки модели
         model_settings = self.model_settings["gpt-4"]
@@ -172,23 +313,25 @@ class OpenAIClient:
         optimal_limit = self.token_monitor.get_optimal_token_limit(user_id, len(context.split('\n')))
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[{"role": "user", "content": full_prompt}],
-                max_tokens=min(optimal_limit, model_settings["max_tokens"]),
-                temperature=model_settings["temperature"],
-                timeout=model_settings["timeout"]
-            )
+            async with self._api_slots:
+                response = await self.client.chat.completions.create(
+                    model="gpt-4",
+                    messages=messages,
+                    max_tokens=min(optimal_limit, model_settings["max_tokens"]),
+                    temperature=model_settings["temperature"],
+                    timeout=model_settings["timeout"],
+                    extra_body=extra_body
+                )
             
             return response.choices[0].message.content.strip()
             
         except openai.RateLimitError:
             logger.warning(f"Превышен лимит запросов для пользователя {user_id}")
-            return "Извините, слишком много запросов. Попробуйте через несколько минут."
+            return _RATE_LIMIT_REPLY
         
         except openai.APITimeoutError:
             logger.warning(f"Таймаут API для пользователя {user_id}")
-            return "Извините, запрос занял слишком много времени. Попробуйте еще раз."
+            return _TIMEOUT_REPLY
         
         except Exception as e:
             logger.error(f"Неожиданная ошибка OpenAI: {e}")
@@ -200,13 +343,14 @@ class OpenAIClient:
         continuation_prompt = self.token_manager.get_continuation_prompt(truncated_response)
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[{"role": "user", "content": continuation_prompt}],
-                max_tokens=500,  # Ограничиваем продолжение
-                temperature=0.7,
-                timeout=30
-            )
+            async with self._api_slots:
+                response = await self.client.chat.completions.create(
+                    model="gpt-4",
+                    messages=[{"role": "user", "content": continuation_prompt}],
+                    max_tokens=500,  # Ограничиваем продолжение
+                    temperature=0.7,
+                    timeout=30
+                )
             
             return response.choices[0].message.content.strip()
             
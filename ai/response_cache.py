@@ -31,13 +31,10 @@ class ResponseCache:
         self.max_size = config.cache_size
         self.default_ttl = config.cache_ttl
         
-        # Статистика кэша
-        self.stats = {
-            'hits': 0,
-            'misses': 0,
-            'evictions': 0,
-            'total_requests': 0
-        }
+        # Статистика кэша: простые счетчики, total_requests вычисляется при чтении
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
         
         # Настройки TTL для разных типов ответов
         self.ttl_settings = {
@@ -48,6 +45,16 @@ class ResponseCache:
             'default': config.cache_ttl
         }
     
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Снимок статистики кэша"""
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'total_requests': self._hits + self._misses
+        }
+    
     def _generate_cache_key(self, prompt: str, user_id: int, context: str = "") -> str:
         """Генерация ключа кэша"""
         # Создаем хэш на основе промпта, пользователя и контекста
@@ -62,27 +69,24 @@ class ResponseCache:
     def get(self, prompt: str, user_id: int, context: str = "", response_type: str = "default") -> Optional[str]:
         """Получение ответа из кэша"""
         
-        self.stats['total_requests'] += 1
-        
         cache_key = self._generate_cache_key(prompt, user_id, context)
         
-        if cache_key not in self.cache:
-            self.stats['misses'] += 1
+        cached_response = self.cache.get(cache_key)
+        if cached_response is None:
+            self._misses += 1
             return None
         
-        cached_response = self.cache[cache_key]
-        
         # Проверяем срок действия
         ttl = self.ttl_settings.get(response_type, self.default_ttl)
         if self._is_expired(cached_response, ttl):
             del self.cache[cache_key]
-            self.stats['misses'] += 1
+            self._misses += 1
             logger.debug(f"Кэш истек для ключа {cache_key}")
             return None
         
         # Обновляем статистику использования
         cached_response.hit_count += 1
-        self.stats['hits'] += 1
+        self._hits += 1
         
         # Перемещаем в конец (LRU)
         self.cache.move_to_end(cache_key)
@@ -135,7 +139,7 @@ class ResponseCache:
         # Удаляем первый элемент (самый старый)
         oldest_key = next(iter(self.cache))
         del self.cache[oldest_key]
-        self.stats['evictions'] += 1
+        self._evictions += 1
         
         logger.debug(f"Удален из кэша ключ {oldest_key}")
     
@@ -168,9 +172,10 @@ class ResponseCache:
     def get_cache_stats(self) -> Dict[str, Any]:
         """Получение статистики кэша"""
         
-        total_requests = self.stats['total_requests']
+        hits = self._hits
+        total_requests = hits + self._misses
         hit_rate = (
-            self.stats['hits'] / total_requests 
+            hits / total_requests 
             if total_requests > 0 else 0
         )
         
@@ -188,9 +193,9 @@ class ResponseCache:
             'total_entries': len(self.cache),
             'max_size': self.max_size,
             'hit_rate': hit_rate,
-            'hits': self.stats['hits'],
-            'misses': self.stats['misses'],
-            'evictions': self.stats['evictions'],
+            'hits': hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
             'type_stats': type_stats,
             'memory_usage_estimate': self._estimate_memory_usage()
         }
@@ -255,12 +260,9 @@ class ResponseCache:
         """Полная очистка кэша"""
         
         self.cache.clear()
-        self.stats = {
-            'hits': 0,
-            'misses': 0,
-            'evictions': 0,
-            'total_requests': 0
-        }
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
         
         logger.info("Кэш полностью очищен")
     
@@ -318,7 +320,7 @@ class ResponseCache:
             )
         
         # Рекомендации по настройке
-        hit_rate = self.stats['hits'] / max(self.stats['total_requests'], 1)
+        hit_rate = self._hits / max(self._hits + self._misses, 1)
         
         if hit_rate < 0.3:
             optimizations['recommendations'].append(
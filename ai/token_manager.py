@@ -2,15 +2,60 @@
 Менеджер токенов для оптимизации использования OpenAI API
 """
 
+import re
 import logging
+from functools import lru_cache
 from typing import Dict, List, Tuple, Optional
 from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+# Ключевые слова для сжатия контекста: одна скомпилированная альтернатива
+# вместо отдельного поиска подстроки для каждого слова. Совпадение по подстроке
+# сохраняет формы слов ("проблемами", "работать")
+_CONTEXT_KEY_WORDS_RE = re.compile('|'.join(map(re.escape, (
+    'важно', 'проблема', 'цель', 'мечта', 'страх', 'тревога', 'работа', 'карьера'
+))), re.IGNORECASE)
+
+@lru_cache(maxsize=4)
+def get_encoding(name: str = "cl100k_base"):
+    """Общий на процесс BPE-энкодер tiktoken (None, если tiktoken недоступен)"""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding(name)
+        logger.info("Tiktoken успешно инициализирован")
+        return encoding
+    except ImportError:
+        logger.warning("Tiktoken не установлен. Используется fallback подсчет токенов.")
+    except Exception as e:
+        logger.warning(f"Не удалось инициализировать tiktoken: {e}. Используется fallback.")
+    return None
+
+# Основы слов для оценки релевантности контекста вопросу: первые 5 букв слов
+# длиной от 4 букв, чтобы формы слова совпадали ("работу", "работать")
+_STEM_RE = re.compile(r'\w{4,}')
+
+def _stems(text: str) -> frozenset:
+    """Множество основ слов текста"""
+    return frozenset(word[:5] for word in _STEM_RE.findall(text.lower()))
+
+# Признаки обрезанного ответа модели
+_TRUNCATED_ENDINGS = ('...', '…')
+_COMPLETE_ENDINGS = '.!?'  # Проверка последнего символа одним поиском в строке
+_CONTINUATION_RE = re.compile(r'продолжение следует|to be continued', re.IGNORECASE)
+
+# Тексты длиннее этого порога (склеенный контекст диалога) почти не повторяются
+# и только раздували бы кэш, поэтому считаются без мемоизации
+_TOKEN_CACHE_MAX_TEXT = 4000
+
+@lru_cache(maxsize=2048)
+def _cached_token_count(encoding_name: str, text: str) -> int:
+    """Число токенов для повторяющихся текстов (системные промпты, шаблоны вопросов)"""
+    return len(get_encoding(encoding_name).encode_ordinary(text))
+
+@dataclass(slots=True, frozen=True)
 class TokenUsage:
-    """Информация об использовании токенов"""
+    """Информация об использовании токенов (неизменяемая)"""
     prompt_tokens: int
     completion_tokens: int
     total_tokens: int
@@ -21,29 +66,27 @@ class TokenManager:
     
     def __init__(self, config):
         self.config = config
-        # Пытаемся импортировать и инициализировать tiktoken
-        try:
-            import tiktoken
-            self.encoding = tiktoken.get_encoding("cl100k_base")
-            logger.info("Tiktoken успешно инициализирован")
-        except ImportError:
-            logger.warning("Tiktoken не установлен. Используется fallback подсчет токенов.")
-            self.encoding = None
-        except Exception as e:
-            logger.warning(f"Не удалось инициализировать tiktoken: {e}. Используется fallback.")
-            self.encoding = None
+        # Энкодер tiktoken создается один раз на процесс и общий для всех экземпляров
+        self.encoding = get_encoding("cl100k_base")
         
         # Стоимость токенов для GPT-4 (примерная)
         self.token_costs = {
             "gpt-4": {"input": 0.03, "output": 0.06},  # за 1K токенов
             "gpt-3.5-turbo": {"input": 0.001, "output": 0.002}
         }
+        # Цена одного входного токена, посчитанная заранее для _calculate_cost
+        self._input_token_cost = {
+            model: costs["input"] / 1000 for model, costs in self.token_costs.items()
+        }
     
     def count_tokens(self, text: str) -> int:
         """Подсчет токенов в тексте"""
         try:
             if self.encoding:
-                return len(self.encoding.encode(text))
+                if len(text) <= _TOKEN_CACHE_MAX_TEXT:
+                    return _cached_token_count(self.encoding.name, text)
+                # encode_ordinary не ищет спецтокены: быстрее и не падает на "<|endoftext|>"
+                return len(self.encoding.encode_ordinary(text))
             else:
                 # Примерная оценка: 1 токен ≈ 4 символа
                 return len(text) // 4
@@ -54,6 +97,14 @@ class TokenManager:
     
     def count_tokens_list(self, texts: List[str]) -> int:
         """Подсчет токенов в списке текстов"""
+        # Пакетное кодирование в Rust без GIL выгодно только на больших списках:
+        # tiktoken создает пул потоков на каждый вызов encode_ordinary_batch
+        if self.encoding and len(texts) >= 8:
+            try:
+                encoded = self.encoding.encode_ordinary_batch(texts, num_threads=min(8, len(texts)))
+                return sum(map(len, encoded))
+            except Exception as e:
+                logger.error(f"Ошибка пакетного подсчета токенов: {e}")
         return sum(self.count_tokens(text) for text in texts)
     
     def estimate_response_tokens(self, prompt_tokens: int, context_length: int) -> int:
@@ -68,10 +119,19 @@ class TokenManager:
         response_tokens = getattr(self.config, 'response_tokens', 1000)
         return min(base_estimate, response_tokens)
     
+    def _count_prompt_context(self, prompt: str, context: str,
+                              prompt_tokens: Optional[int] = None,
+                              context_tokens: Optional[int] = None) -> Tuple[int, int]:
+        """Токены промпта и контекста; уже известные значения не пересчитываются"""
+        if prompt_tokens is None:
+            prompt_tokens = self.count_tokens(prompt)
+        if context_tokens is None:
+            context_tokens = self.count_tokens(context)
+        return prompt_tokens, context_tokens
+    
     def calculate_available_tokens(self, prompt: str, context: str, user_type: str = "free") -> int:
         """Расчет доступных токенов для ответа"""
-        prompt_tokens = self.count_tokens(prompt)
-        context_tokens = self.count_tokens(context)
+        prompt_tokens, context_tokens = self._count_prompt_context(prompt, context)
         
         # Получаем лимиты для пользователя
         user_limits = self.config.get_user_limits(user_type)
@@ -88,10 +148,17 @@ class TokenManager:
         
         return context_tokens
     
-    def optimize_prompt(self, prompt: str, context: str, user_type: str = "free") -> Tuple[str, str, TokenUsage]:
-        """Оптимизация промпта с учетом лимитов токенов"""
-        prompt_tokens = self.count_tokens(prompt)
-        context_tokens = self.count_tokens(context)
+    def optimize_prompt(self, prompt: str, context: str, user_type: str = "free",
+                        query: str = "", prompt_tokens: Optional[int] = None,
+                        context_tokens: Optional[int] = None) -> Tuple[str, str, TokenUsage]:
+        """Оптимизация промпта с учетом лимитов токенов
+        
+        query - текущий вопрос пользователя; prompt_tokens/context_tokens - уже
+        посчитанные вызывающим кодом значения (не пересчитываются).
+        """
+        prompt_tokens, context_tokens = self._count_prompt_context(
+            prompt, context, prompt_tokens, context_tokens
+        )
         
         # Получаем адаптивные лимиты
         conversation_length = len(context.split('\n')) if context else 0
@@ -121,10 +188,12 @@ class TokenManager:
             max_context_tokens = getattr(self.config, 'min_tokens', 100)
             logger.warning(f"Промпт слишком длинный, используется минимальный контекст")
         
-        # Сжимаем контекст
-        compressed_context = self._compress_context(context, max_context_tokens)
+        # Сжимаем контекст (токены контекста уже посчитаны выше)
+        compressed_context, compressed_tokens = self._compress_context(
+            context, max_context_tokens, context_tokens, query
+        )
         
-        final_tokens = prompt_tokens + self.count_tokens(compressed_context)
+        final_tokens = prompt_tokens + compressed_tokens
         estimated_cost = self._calculate_cost(final_tokens, "gpt-4")
         
         return prompt, compressed_context, TokenUsage(
@@ -134,39 +203,78 @@ class TokenManager:
             estimated_cost=estimated_cost
         )
     
-    def _compress_context(self, context: str, max_tokens: int) -> str:
-        """Сжатие контекста с сохранением важной информации"""
-        if self.count_tokens(context) <= max_tokens:
-            return context
-        
-        # Разбиваем на предложения
+    def _compress_context(self, context: str, max_tokens: int,
+                          context_tokens: Optional[int] = None, query: str = "") -> Tuple[str, int]:
+        """Сжатие контекста с учетом вопроса пользователя: (текст, число токенов)"""
+        if context_tokens is None:
+            context_tokens = self.count_tokens(context)
+        if context_tokens <= max_tokens:
+            return context, context_tokens
+        
+        # Разбиваем на предложения и считаем токены каждого один раз
         sentences = context.split('. ')
-        
-        # Приоритизируем последние предложения
-        important_sentences = sentences[-3:]  # Последние 3 предложения
-        
-        # Добавляем предложения с ключевыми словами
-        key_words = ['важно', 'проблема', 'цель', 'мечта', 'страх', 'тревога', 'работа', 'карьера']
-        for sentence in sentences[:-3]:
-            if any(word in sentence.lower() for word in key_words):
-                important_sentences.insert(-3, sentence)
-        
-        # Собираем сжатый контекст
-        compressed = '. '.join(important_sentences)
-        
-        # Если все еще не помещается, обрезаем
-        while self.count_tokens(compressed) > max_tokens and len(compressed) > 100:
-            compressed = compressed[:-100] + "..."
-        
-        return compressed
+        sentence_tokens = [self.count_tokens(sentence) for sentence in sentences]
+        
+        # Вопрос: текущее сообщение пользователя плюс последние 3 предложения диалога
+        recent_start = len(sentences) - 3
+        query_stems = _stems(query).union(*map(_stems, sentences[max(recent_start, 0):]))
+        
+        # Оценка: последние 3 предложения всегда первыми; остальные - ключевые слова
+        # плюс доля основ слов, общих с вопросом. Предложения больше бюджета не оцениваем
+        candidates = []
+        for i, sentence in enumerate(sentences):
+            if i >= recent_start:
+                candidates.append((3.0, i))
+                continue
+            if sentence_tokens[i] > max_tokens:
+                continue
+            
+            stems = _stems(sentence)
+            score = len(stems & query_stems) / len(stems) if stems else 0.0
+            if _CONTEXT_KEY_WORDS_RE.search(sentence):
+                score += 1.0
+            if score > 0:
+                candidates.append((score, i))
+        
+        # По убыванию оценки, при равной оценке - более свежие
+        candidates.sort(reverse=True)
+        
+        # Жадно заполняем бюджет (разделитель ". " считаем за один токен)
+        selected = []
+        used_tokens = 0
+        for _, i in candidates:
+            cost = sentence_tokens[i] + (1 if selected else 0)
+            if used_tokens + cost <= max_tokens:
+                selected.append(i)
+                used_tokens += cost
+        
+        if not selected:
+            # Не поместилось ни одно предложение - обрезаем последнее
+            truncated = self._truncate_to_tokens(sentences[-1], max_tokens)
+            return truncated, self.count_tokens(truncated)
+        
+        # Возвращаем предложения в исходном порядке; число токенов уже известно из отбора
+        selected.sort()
+        return '. '.join(sentences[i] for i in selected), used_tokens
+    
+    def _truncate_to_tokens(self, text: str, max_tokens: int) -> str:
+        """Обрезка текста до указанного числа токенов"""
+        if self.encoding:
+            token_ids = self.encoding.encode_ordinary(text)
+            if len(token_ids) <= max_tokens:
+                return text
+            # Срез может разрезать многобайтовый символ - убираем символ замены
+            return self.encoding.decode(token_ids[:max_tokens]).rstrip('\ufffd') + "..."
+        
+        max_chars = max_tokens * 4  # Примерное соотношение
+        return text if len(text) <= max_chars else text[:max_chars] + "..."
     
     def _calculate_cost(self, tokens: int, model: str = "gpt-4") -> float:
         """Расчет примерной стоимости запроса"""
-        if model not in self.token_costs:
-            model = "gpt-4"
-        
-        cost_per_1k = self.token_costs[model]["input"]
-        return (tokens / 1000) * cost_per_1k
+        token_cost = self._input_token_cost.get(model)
+        if token_cost is None:
+            token_cost = self._input_token_cost["gpt-4"]
+        return tokens * token_cost
     
     def split_long_response(self, response: str, max_length: int = None) -> List[str]:
         """Разбиение длинного ответа на части"""
@@ -176,72 +284,63 @@ class TokenManager:
         if len(response) <= max_length:
             return [response]
         
-        parts = []
-        current_part = ""
-        
-        # Разбиваем по абзацам
-        paragraphs = response.split('\n\n')
-        
-        for paragraph in paragraphs:
-            if len(current_part + paragraph) <= max_length:
-                current_part += "\n\n" + paragraph if current_part else paragraph
-            else:
-                if current_part:
-                    parts.append(current_part.strip())
-                
-                # Если один абзац слишком длинный, разбиваем его
-                if len(paragraph) > max_length:
-                    sub_parts = self._split_long_paragraph(paragraph, max_length)
-                    parts.extend(sub_parts[:-1])  # Добавляем все кроме последнего
-                    current_part = sub_parts[-1]  # Последний становится текущим
-                else:
-                    current_part = paragraph
-        
-        if current_part:
-            parts.append(current_part.strip())
-        
-        return parts
+        # Текущая часть копится списком и склеивается один раз при сбросе,
+        # вместо пересборки строки на каждом абзаце
+        return self._pack_chunks(response.split('\n\n'), '\n\n', max_length, split_long=True)
     
     def _split_long_paragraph(self, paragraph: str, max_length: int) -> List[str]:
         """Разбиение длинного абзаца на части"""
+        return self._pack_chunks(paragraph.split('. '), '. ', max_length)
+    
+    def _pack_chunks(self, chunks: List[str], sep: str, max_length: int,
+                     split_long: bool = False) -> List[str]:
+        """Жадная упаковка фрагментов в части не длиннее max_length"""
         parts = []
-        current_part = ""
-        
-        sentences = paragraph.split('. ')
-        
-        for sentence in sentences:
-            if len(current_part + sentence) <= max_length:
-                current_part += ". " + sentence if current_part else sentence
-            else:
-                if current_part:
-                    parts.append(current_part.strip())
-                current_part = sentence
+        buf: List[str] = []
+        buf_len = 0  # Длина sep.join(buf); пустая часть не получает разделитель
+        
+        for chunk in chunks:
+            if buf_len + len(chunk) <= max_length:
+                if buf_len:
+                    buf.append(chunk)
+                    buf_len += len(sep) + len(chunk)
+                else:
+                    buf = [chunk]
+                    buf_len = len(chunk)
+                continue
+            
+            if buf_len:
+                parts.append(sep.join(buf).strip())
+            
+            # Если один абзац слишком длинный, разбиваем его по предложениям
+            if split_long and len(chunk) > max_length:
+                sub_parts = self._split_long_paragraph(chunk, max_length) or [""]
+                parts.extend(sub_parts[:-1])  # Добавляем все кроме последнего
+                chunk = sub_parts[-1]  # Последний становится текущим
+            
+            buf = [chunk]
+            buf_len = len(chunk)
         
-        if current_part:
-            parts.append(current_part.strip())
+        if buf_len:
+            parts.append(sep.join(buf).strip())
         
         return parts
     
     def is_response_truncated(self, response: str) -> bool:
         """Проверка, обрезан ли ответ"""
-        # Простые индикаторы обрезанного ответа
-        truncation_indicators = [
-            response.endswith('...'),
-            response.endswith('...'),
-            not response.endswith('.'),
-            not response.endswith('!'),
-            not response.endswith('?'),
-            len(response.split()) < 10  # Слишком короткий ответ
-        ]
-        
-        return any(truncation_indicators)
+        # Простые индикаторы обрезанного ответа; дешевые проверки идут первыми,
+        # регулярка выполняется только если они не сработали
+        return (
+            len(response) < 40  # Слишком короткий ответ
+            or response[-1:] not in _COMPLETE_ENDINGS
+            or response.endswith(_TRUNCATED_ENDINGS)
+            or _CONTINUATION_RE.search(response) is not None
+        )
     
     def get_continuation_prompt(self, truncated_response: str) -> str:
         """Получение промпта для продолжения обрезанного ответа"""
-        # Берем последние 200 символов для контекста
-        context = truncated_response[-200:] if len(truncated_response) > 200 else truncated_response
-        
+        # Берем последние 200 символов для контекста (срез сам обрабатывает короткие строки)
         return f"""Продолжи ответ с того места, где остановился. 
-Контекст: {context}
+Контекст: {truncated_response[-200:]}
 
 Продолжение:"""
\ No newline at end of file
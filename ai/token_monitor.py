@@ -11,15 +11,19 @@ from collections import defaultdict, deque
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+@dataclass(slots=True)
 class TokenUsageStats:
-    """Статистика использования токенов"""
+    """Статистика использования токенов (хранятся только счетчики)"""
     total_tokens: int = 0
     total_requests: int = 0
     truncated_responses: int = 0
     avg_response_length: float = 0.0
-    avg_tokens_per_request: float = 0.0
     last_updated: datetime = field(default_factory=datetime.now)
+    
+    @property
+    def avg_tokens_per_request(self) -> float:
+        """Среднее число токенов на запрос (вычисляется при чтении)"""
+        return self.total_tokens / max(self.total_requests, 1)
 
 @dataclass
 class UserPatterns:
@@ -72,14 +76,12 @@ class TokenMonitor:
         """Отслеживание запроса пользователя"""
         
         # Обновляем общую статистику
-        self.usage_stats.total_tokens += prompt_tokens + response_tokens
-        self.usage_stats.total_requests += 1
-        self.usage_stats.avg_tokens_per_request = (
-            self.usage_stats.total_tokens / self.usage_stats.total_requests
-        )
+        usage_stats = self.usage_stats
+        usage_stats.total_tokens += prompt_tokens + response_tokens
+        usage_stats.total_requests += 1
         
         if truncated:
-            self.usage_stats.truncated_responses += 1
+            usage_stats.truncated_responses += 1
         
         # Обновляем статистику пользователя
         if user_id not in self.user_patterns:
@@ -4,12 +4,31 @@
 
 import os
 import yaml
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Any, Optional
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional
 from pydantic import Field, validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+@lru_cache(maxsize=8)
+def _build_user_limits(max_tokens: int, cache_ttl: int) -> Mapping[str, Mapping[str, int]]:
+    """Таблица лимитов по типам пользователей (неизменяемая, строится один раз)"""
+    return MappingProxyType({
+        "free": MappingProxyType({
+            "max_tokens": max_tokens,
+            "max_messages": 10,
+            "cache_ttl": cache_ttl
+        }),
+        "premium": MappingProxyType({
+            "max_tokens": max_tokens + 1000,
+            "max_messages": 20,
+            "cache_ttl": cache_ttl * 2
+        })
+    })
+
+
 class BotConfig(BaseSettings):
     """Конфигурация бота с валидацией"""
     
@@ -31,14 +50,28 @@ class BotConfig(BaseSettings):
     # Настройки кэширования
     cache_ttl: int = Field(3600, ge=300, le=86400, description="Cache TTL in seconds")
     cache_size: int = Field(1000, ge=100, le=10000, description="Cache size")
+    analysis_cache_ttl: int = Field(30 * 86400, ge=3600, le=90 * 86400, description="Test analysis cache TTL in seconds")
     
     # Настройки мониторинга
     monitoring_enabled: bool = Field(True, description="Enable monitoring")
     auto_optimization: bool = Field(True, description="Enable auto optimization")
     
+    # Настройки обработки обновлений
+    concurrent_updates: int = Field(8, ge=1, le=256, description="Updates processed concurrently")
+    message_batch_delay: float = Field(0.3, ge=0.0, le=5.0, description="Seconds to coalesce a burst of chat messages")
+    max_concurrent_requests: int = Field(16, ge=1, le=128, description="Max simultaneous OpenAI requests")
+    
+    # Настройки webhook (если URL не задан, используется long polling)
+    webhook_url: Optional[str] = Field(None, description="Public HTTPS URL for Telegram webhook")
+    webhook_port: int = Field(8443, ge=1, le=65535, description="Local port for webhook server")
+    webhook_max_connections: int = Field(40, ge=1, le=100, description="Max simultaneous webhook connections")
+    
     # Настройки базы данных
     database_path: str = Field("psychoanalyst.db", description="Database path")
     
+    # Сохранение user_data (незавершенные тесты) между перезапусками; None - только в памяти
+    persistence_path: Optional[str] = Field(None, description="PicklePersistence file for user_data")
+    
     # Настройки логирования
     log_level: str = Field("INFO", description="Log level")
     log_file: Optional[str] = Field(None, description="Log file path")
@@ -55,7 +88,8 @@ class BotConfig(BaseSettings):
         env_file=".env",
         env_file_encoding="utf-8",
         case_sensitive=False,
-        extra="ignore"
+        extra="ignore",
+        frozen=True  # Конфигурация неизменяема после загрузки
     )
     
     @validator('log_level')
@@ -94,6 +128,8 @@ class BotConfig(BaseSettings):
             'openai_api_key': os.getenv('OPENAI_API_KEY', ''),
             'bot_token': os.getenv('BOT_TOKEN', ''),
             'payment_token': os.getenv('PAYMENT_TOKEN'),
+            'webhook_url': os.getenv('WEBHOOK_URL') or None,
+            'webhook_port': int(os.getenv('PORT') or os.getenv('WEBHOOK_PORT') or 8443),
             'database_path': db_config.get('path', 'psychoanalyst.db'),
             'log_level': log_config.get('level', 'INFO'),
             'log_file': log_config.get('files', {}).get('main'),
@@ -103,25 +139,14 @@ class BotConfig(BaseSettings):
         
         return cls(**merged_config)
     
-    def get_user_limits(self, user_type: str = "free") -> Dict[str, int]:
-        """Получить лимиты для типа пользователя"""
-        limits = {
-            "free": {
-                "max_tokens": self.max_tokens,
-                "max_messages": 10,
-                "cache_ttl": self.cache_ttl
-            },
-            "premium": {
-                "max_tokens": self.max_tokens + 1000,
-                "max_messages": 20,
-                "cache_ttl": self.cache_ttl * 2
-            }
-        }
+    def get_user_limits(self, user_type: str = "free") -> Mapping[str, int]:
+        """Получить лимиты для типа пользователя (только для чтения)"""
+        limits = _build_user_limits(self.max_tokens, self.cache_ttl)
         return limits.get(user_type, limits["free"])
     
     def get_adaptive_limits(self, conversation_length: int, user_type: str = "free") -> Dict[str, int]:
         """Получить адаптивные лимиты на основе контекста"""
-        base_limits = self.get_user_limits(user_type)
+        base_limits = dict(self.get_user_limits(user_type))
         
         # Адаптация на основе длины диалога
         if conversation_length > 15:
@@ -4,15 +4,35 @@
 
 import sqlite3
 import json
+import asyncio
 import logging
-from typing import Dict, List, Optional, Any, Union
+from typing import Dict, List, Optional, Any, Set, Tuple, Union
 from datetime import datetime
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+# Локальные алиасы для горячих путей (без LOAD_ATTR на каждый вызов)
+_loads = json.loads
+
+# Анализы по 1500 слов сериализуются на каждом сохранении: orjson в 2-5 раз быстрее
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(data: Any) -> str:
+        """Сериализация в JSON-строку (UTF-8 без экранирования, как ensure_ascii=False)"""
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+except ImportError:
+    def _dumps(data: Any) -> str:
+        """Сериализация в JSON-строку (UTF-8 без экранирования)"""
+        return json.dumps(data, ensure_ascii=False)
+
+_fromisoformat = datetime.fromisoformat
+
+@dataclass(slots=True, frozen=True)
 class AnalysisRecord:
     """Запись анализа с типизацией"""
     id: int
@@ -24,21 +44,41 @@ class AnalysisRecord:
     created_at: datetime
     
     def to_dict(self) -> Dict[str, Any]:
-        """Преобразование в словарь"""
-        return asdict(self)
+        """Преобразование в словарь (без рекурсивного копирования asdict)"""
+        return {
+            'id': self.id,
+            'telegram_id': self.telegram_id,
+            'name': self.name,
+            'analysis_type': self.analysis_type,
+            'analysis_data': self.analysis_data,
+            'payment_status': self.payment_status,
+            'created_at': self.created_at
+        }
     
     @classmethod
     def from_row(cls, row: tuple) -> 'AnalysisRecord':
         """Создание из строки БД"""
         return cls(
-            id=row[0],
-            telegram_id=row[1],
-            name=row[2],
-            analysis_type=row[3],
-            analysis_data=json.loads(row[4]) if row[4] else {},
-            payment_status=row[5],
-            created_at=datetime.fromisoformat(row[6])
+            row[0],
+            row[1],
+            row[2],
+            row[3],
+            _loads(row[4]) if row[4] else {},
+            row[5],
+            _fromisoformat(row[6])
         )
+    
+    @classmethod
+    def from_rows(cls, rows: List[tuple]) -> List['AnalysisRecord']:
+        """Пакетное создание из строк БД за один проход"""
+        loads = _loads
+        fromisoformat = _fromisoformat
+        return [
+            cls(row[0], row[1], row[2], row[3],
+                loads(row[4]) if row[4] else {},
+                row[5], fromisoformat(row[6]))
+            for row in rows
+        ]
 
 @dataclass
 class PromptVariant:
@@ -78,15 +118,35 @@ class DatabaseManager:
             'isolation_level': None,  # Автокоммит
             'check_same_thread': False
         }
+        
+        # PRAGMA уровня подключения (действуют только на текущее соединение)
+        self.connection_pragmas = (
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA busy_timeout=5000',           # Ожидание блокировки WAL вместо "database is locked"
+            'PRAGMA mmap_size=268435456',         # 256 MB чтения страниц через mmap
+            'PRAGMA cache_size=-131072',          # 128 MB кэша страниц (в KiB)
+            'PRAGMA temp_store=MEMORY',
+            'PRAGMA wal_autocheckpoint=1000',
+            'PRAGMA journal_size_limit=67108864'  # 64 MB максимум для WAL после checkpoint
+        )
+        
+        # Известные пары (telegram_id, analysis_type): анализы только добавляются
+        # и перезаписываются, поэтому положительный ответ has_analysis не устаревает,
+        # пока его не сбросят clear_user_data / clear_all_data
+        self._known_analyses: Set[Tuple[int, str]] = set()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие подключения с настройками PRAGMA"""
+        conn = sqlite3.connect(self.db_path, **self.connection_params)
+        for pragma in self.connection_pragmas:
+            conn.execute(pragma)
+        return conn
     
     async def init_database(self) -> bool:
         """Инициализация базы данных с проверкой ошибок"""
         try:
-            with sqlite3.connect(self.db_path, **self.connection_params) as conn:
-                conn.execute('PRAGMA journal_mode=WAL')  # WAL режим для производительности
-                conn.execute('PRAGMA synchronous=NORMAL')
-                conn.execute('PRAGMA cache_size=10000')
-                conn.execute('PRAGMA temp_store=MEMORY')
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')  # WAL режим для производительности (сохраняется в файле БД)
                 
                 cursor = conn.cursor()
                 
@@ -105,10 +165,17 @@ class DatabaseManager:
                 ''')
                 
                 # Индексы для производительности
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_telegram_id ON clients(telegram_id)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_analysis_type ON clients(analysis_type)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_created_at ON clients(created_at)')
                 
+                # Составной индекс покрывает проверку (telegram_id, analysis_type) в save_analysis
+                # и has_analysis, а его префикс - выборки по одному telegram_id,
+                # поэтому отдельные индексы по этим колонкам только замедляют запись
+                cursor.execute('DROP INDEX IF EXISTS idx_clients_analysis_type')
+                cursor.execute('DROP INDEX IF EXISTS idx_clients_telegram_id')
+                cursor.execute(
+                    'CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_tg_type ON clients(telegram_id, analysis_type)'
+                )
+                
                 # Таблица для A/B тестирования промптов
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS prompt_variants (
@@ -172,6 +239,9 @@ class DatabaseManager:
                 
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_usage_stats_user_date ON usage_stats(user_id, date)')
                 
+                # Обновляем статистику для планировщика запросов
+                cursor.execute('ANALYZE clients')
+                
                 conn.commit()
                 logger.info("База данных инициализирована успешно")
                 return True
@@ -190,7 +260,11 @@ class DatabaseManager:
     ) -> Optional[int]:
         """Сохранение анализа с улучшенной обработкой ошибок"""
         try:
-            with sqlite3.connect(self.db_path, **self.connection_params) as conn:
+            # Сериализуем и берем время один раз для обеих веток
+            payload = _dumps(analysis_data)
+            now = datetime.now()
+            
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 # Проверяем существование записи
@@ -208,9 +282,9 @@ class DatabaseManager:
                         WHERE telegram_id = ? AND analysis_type = ?
                     ''', (
                         name, 
-                        json.dumps(analysis_data, ensure_ascii=False), 
+                        payload, 
                         payment_status, 
-                        datetime.now(),
+                        now,
                         telegram_id, 
                         analysis_type
                     ))
@@ -225,14 +299,15 @@ class DatabaseManager:
                         telegram_id, 
                         name, 
                         analysis_type, 
-                        json.dumps(analysis_data, ensure_ascii=False), 
+                        payload, 
                         payment_status, 
-                        datetime.now(),
-                        datetime.now()
+                        now,
+                        now
                     ))
                     analysis_id = cursor.lastrowid
                 
                 conn.commit()
+                self._known_analyses.add((telegram_id, analysis_type))
                 logger.info(f"Анализ сохранен: ID {analysis_id}, пользователь {telegram_id}")
                 return analysis_id
                 
@@ -240,10 +315,87 @@ class DatabaseManager:
             logger.error(f"Ошибка сохранения анализа: {e}")
             return None
     
+    async def save_analyses_bulk(self, rows: List[tuple]) -> List[tuple]:
+        """Пакетное сохранение анализов одной транзакцией
+        
+        rows - кортежи (telegram_id, name, analysis_type, analysis_data, payment_status).
+        Запись идет в отдельном потоке, чтобы не блокировать цикл событий.
+        Возвращает строки, не записанные из-за временной ошибки (например,
+        "database is locked"): вызывающий ставит их в очередь повторно.
+        """
+        if not rows:
+            return []
+        try:
+            saved, retry = await asyncio.to_thread(self._save_analyses_bulk_sync, rows)
+        except sqlite3.Error as e:
+            # База недоступна целиком (не открылось подключение) - повторим весь пакет
+            logger.error(f"Ошибка пакетного сохранения анализов: {e}")
+            return list(rows)
+        
+        # Множество известных анализов меняется только в цикле событий, не в потоке записи
+        self._known_analyses.update(saved)
+        return retry
+    
+    def _save_analyses_bulk_sync(self, rows: List[tuple]) -> Tuple[List[Tuple[int, str]], List[tuple]]:
+        """Синхронная часть save_analyses_bulk: один executemany с UPSERT
+        
+        Возвращает ключи (telegram_id, analysis_type) записанных строк и строки для повтора.
+        """
+        now = datetime.now()
+        # Исходные строки хранятся рядом с параметрами: их возвращают на повтор
+        sources = []
+        params = []
+        for row in rows:
+            telegram_id, name, analysis_type, analysis_data, payment_status = row
+            try:
+                params.append((telegram_id, name, analysis_type, _dumps(analysis_data),
+                               payment_status, now, now))
+                sources.append(row)
+            except (TypeError, ValueError) as e:
+                logger.error(f"Анализ пользователя {telegram_id} не сериализуется: {e}")
+        upsert = '''
+            INSERT INTO clients 
+            (telegram_id, name, analysis_type, analysis_data, payment_status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(telegram_id, analysis_type) DO UPDATE SET
+                name = excluded.name,
+                analysis_data = excluded.analysis_data,
+                payment_status = excluded.payment_status,
+                updated_at = excluded.updated_at
+        '''
+        
+        retry = []
+        with self._connect() as conn:
+            try:
+                conn.execute('BEGIN')
+                conn.executemany(upsert, params)
+                conn.execute('COMMIT')
+                saved = [(row[0], row[2]) for row in params]
+            except sqlite3.Error as e:
+                # Ошибка любой строки откатывает весь пакет - сохраняем построчно
+                # (автокоммит: каждая строка фиксируется сама)
+                logger.warning(f"Пакет анализов не записан ({e}), сохраняем построчно")
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                saved = []
+                for source, row in zip(sources, params):
+                    try:
+                        conn.execute(upsert, row)
+                        saved.append((row[0], row[2]))
+                    except sqlite3.OperationalError as e:
+                        # Блокировка или сбой ввода-вывода - строку можно записать позже
+                        logger.error(f"Анализ пользователя {row[0]} отложен: {e}")
+                        retry.append(source)
+                    except sqlite3.Error as e:
+                        logger.error(f"Ошибка сохранения анализа пользователя {row[0]}: {e}")
+        
+        logger.info(f"Пакетно сохранено анализов: {len(saved)} из {len(params)}")
+        return saved, retry
+    
     async def get_user_analyses(self, telegram_id: int) -> List[AnalysisRecord]:
         """Получение анализов пользователя с типизацией"""
         try:
-            with sqlite3.connect(self.db_path, **self.connection_params) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute(
@@ -251,17 +403,37 @@ class DatabaseManager:
                     (telegram_id,)
                 )
                 
-                rows = cursor.fetchall()
-                return [AnalysisRecord.from_row(row) for row in rows]
+                return AnalysisRecord.from_rows(cursor.fetchall())
                 
         except Exception as e:
             logger.error(f"Ошибка получения анализов: {e}")
             return []
     
+    async def has_analysis(self, telegram_id: int, analysis_type: str) -> bool:
+        """Есть ли у пользователя анализ данного типа (одна строка по индексу, без загрузки данных)"""
+        key = (telegram_id, analysis_type)
+        if key in self._known_analyses:
+            return True
+        
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT 1 FROM clients WHERE telegram_id = ? AND analysis_type = ? LIMIT 1',
+                    key
+                ).fetchone()
+                if row is None:
+                    return False
+                self._known_analyses.add(key)
+                return True
+                
+        except Exception as e:
+            logger.error(f"Ошибка проверки наличия анализа: {e}")
+            return False
+    
     async def get_analysis_by_id(self, analysis_id: int) -> Optional[AnalysisRecord]:
         """Получение анализа по ID"""
         try:
-            with sqlite3.connect(self.db_path, **self.connection_params) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('SELECT * FROM clients WHERE id = ?', (analysis_id,))
@@ -276,9 +448,13 @@ class DatabaseManager:
     async def clear_user_data(self, telegram_id: int) -> bool:
         """Очистка данных пользователя"""
         try:
-            with sqlite3.connect(self.db_path, **self.connection_params) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
+                # Типы удаляемых анализов - чтобы убрать их из множества известных
+                cursor.execute('SELECT analysis_type FROM clients WHERE telegram_id = ?', (telegram_id,))
+                analysis_types = [row[0] for row in cursor.fetchall()]
+                
                 # Удаляем данные пользователя из всех таблиц
                 cursor.execute('DELETE FROM clients WHERE telegram_id = ?', (telegram_id,))
                 cursor.execute('DELETE FROM ab_test_results WHERE user_id = ?', (telegram_id,))
@@ -286,6 +462,8 @@ class DatabaseManager:
                 cursor.execute('DELETE FROM usage_stats WHERE user_id = ?', (telegram_id,))
                 
                 conn.commit()
+                for analysis_type in analysis_types:
+                    self._known_analyses.discard((telegram_id, analysis_type))
                 logger.info(f"Данные пользователя {telegram_id} очищены")
                 return True
                 
@@ -296,7 +474,7 @@ class DatabaseManager:
     async def clear_all_data(self) -> bool:
         """Очистка всех данных"""
         try:
-            with sqlite3.connect(self.db_path, **self.connection_params) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('DELETE FROM clients')
@@ -305,6 +483,7 @@ class DatabaseManager:
                 cursor.execute('DELETE FROM usage_stats')
                 
                 conn.commit()
+                self._known_analyses.clear()
                 logger.info("Все данные очищены")
                 return True
                 
@@ -315,7 +494,7 @@ class DatabaseManager:
     async def get_usage_stats(self, user_id: int, days: int = 30) -> Dict[str, Any]:
         """Получение статистики использования"""
         try:
-            with sqlite3.connect(self.db_path, **self.connection_params) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -345,7 +524,7 @@ class DatabaseManager:
     def get_health_status(self) -> Dict[str, Any]:
         """Получение статуса здоровья базы данных"""
         try:
-            with sqlite3.connect(self.db_path, **self.connection_params) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 # Подсчет записей
@@ -383,6 +562,13 @@ class DatabaseManager:
             }
     
     async def close(self):
-        """Закрытие соединений (для асинхронного контекста)"""
-        # SQLite автоматически закрывает соединения
-        pass
\ No newline at end of file
+        """Закрытие базы данных с checkpoint WAL (для асинхронного контекста)"""
+        try:
+            conn = self._connect()
+            try:
+                # Переносим WAL в основной файл и усекаем его, чтобы рестарт не читал большой журнал
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка закрытия базы данных: {e}")
\ No newline at end of file
@@ -65,6 +65,7 @@ class BotApplication:
         self.database: Optional[DatabaseManager] = None
         self.bot: Optional[HRPsychoanalystBot] = None
         self.running = False
+        self._stop_event = asyncio.Event()
         
     async def initialize(self) -> bool:
         """Инициализация приложения"""
@@ -137,6 +138,7 @@ class BotApplication:
                 await self.database.close()
             
             self.running = False
+            self._stop_event.set()
             logger.info("Приложение остановлено")
             return True
             
@@ -150,13 +152,20 @@ class BotApplication:
     
     def _setup_signal_handlers(self):
         """Настройка обработчиков сигналов для graceful shutdown"""
-        def signal_handler(signum, frame):
+        loop = asyncio.get_running_loop()
+        
+        def signal_handler(signum):
             logger = logging.getLogger(__name__)
             logger.info(f"Получен сигнал {signum}, инициируется остановка...")
-            asyncio.create_task(self.stop())
+            # Будим run(): остановка выполнится в его finally
+            self._stop_event.set()
         
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, signal_handler, signum)
+            except NotImplementedError:
+                # Windows: add_signal_handler не поддерживается, передаем сигнал в цикл событий
+                signal.signal(signum, lambda s, frame: loop.call_soon_threadsafe(signal_handler, s))
     
     async def run(self):
         """Основной цикл приложения"""
@@ -173,9 +182,8 @@ class BotApplication:
                 logger.error("Не удалось запустить приложение")
                 return False
             
-            # Основной цикл
-            while self.running:
-                await asyncio.sleep(1)
+            # Основной цикл: ждем сигнала остановки без опроса
+            await self._stop_event.wait()
             
             return True
             
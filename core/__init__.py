@@ -3,10 +3,18 @@
 Основной бот и его компоненты
 """
 
-# Пустой __init__ - импорты удалены чтобы избежать дублирования
-# Используйте модули из ai/ директории:
+# Ленивый импорт (PEP 562): core.bot тянет telegram, openai и handlers.*,
+# поэтому загружаем его только при первом обращении к HRPsychoanalystBot.
+# Компоненты ИИ импортируйте напрямую из ai/:
 # - ai.token_manager
 # - ai.context_compressor
 # - ai.response_cache
 
-__all__ = []
\ No newline at end of file
+__all__ = ['HRPsychoanalystBot']
+
+
+def __getattr__(name):
+    if name == 'HRPsychoanalystBot':
+        from .bot import HRPsychoanalystBot
+        return HRPsychoanalystBot
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -5,10 +5,25 @@
 Бот "Психология Души" - авторская разработка.
 """
 
+import asyncio
 import logging
-from typing import Dict, Any, Optional
+from functools import cached_property
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlparse
 from telegram import Update
-from telegram.ext import Application, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler as TGMessageHandler, ConversationHandler, CallbackQueryHandler, filters
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, Defaults, MessageHandler as TGMessageHandler, CallbackQueryHandler, PersistenceInput, PicklePersistence, filters
+
+try:
+    from telegram.ext import AIORateLimiter
+except ImportError:  # старые версии python-telegram-bot
+    AIORateLimiter = None
+
+# Без превью ссылок: Telegram не ходит по URL, которые встречаются в ответах модели
+try:
+    from telegram import LinkPreviewOptions
+    _NO_LINK_PREVIEW = {'link_preview_options': LinkPreviewOptions(is_disabled=True)}
+except ImportError:  # python-telegram-bot < 20.8
+    _NO_LINK_PREVIEW = {'disable_web_page_preview': True}
 
 # Импорт BotConfig будет сделан локально, чтобы избежать циклических импортов
 from bot.database import DatabaseManager
@@ -20,62 +35,119 @@ from handlers.conversation_handler import BotConversationHandler
 
 logger = logging.getLogger(__name__)
 
+# Фильтр свободного текста (без команд) собирается один раз на модуль
+_TEXT_NOT_CMD = filters.TEXT & ~filters.COMMAND
+
+# Точные команды из справки: в пачке с другими сообщениями они бы не распознались
+_EXACT_COMMANDS = frozenset({'1', '2'})
+
+def _build_rate_limiter():
+    """Глобальный лимит исходящих запросов Telegram (30 в секунду) или None без aiolimiter"""
+    if AIORateLimiter is None:
+        return None
+    try:
+        return AIORateLimiter()
+    except RuntimeError as e:
+        logger.warning(f"Ограничение частоты запросов к Telegram отключено: {e}")
+        return None
+
 class HRPsychoanalystBot:
     """Основной класс HR-Психоаналитик бота"""
     
     def __init__(self, config: Any, database=None):
         self.config = config
-        self.db = DatabaseManager(config)
+        # Используем переданную базу данных, чтобы не создавать второй менеджер
+        self.db = database if database is not None else DatabaseManager(config)
         self.ai_client = OpenAIClient(config)
         
-        # Инициализируем обработчики
-        self.message_handler = BotMessageHandler(self.ai_client, self.db)
-        self.analysis_handler = AnalysisHandler(self.ai_client, self.db)
-        self.conversation_handler = BotConversationHandler(self.ai_client, self.db)
+        # Обработчики создаются лениво при первом обращении (см. свойства ниже)
         
-        # Даем message_handler доступ к analysis_handler для кнопок теста
-        self.message_handler.analysis_handler = self.analysis_handler
-        self.message_handler.conversation_handler = self.conversation_handler
+        # Micro-batch сообщений: chat_id -> (тексты, последнее обновление, контекст)
+        self.message_batch_delay = getattr(config, 'message_batch_delay', 0.3)
+        self._chat_buffers: Dict[int, Tuple[List[str], Update, ContextTypes.DEFAULT_TYPE]] = {}
+        
+        # Создаем приложение: обновления обрабатываются параллельно пулом задач,
+        # поэтому долгий вызов OpenAI одного пользователя не задерживает остальных
+        builder = (
+            ApplicationBuilder()
+            .token(config.bot_token)
+            .concurrent_updates(getattr(config, 'concurrent_updates', 8))
+            .defaults(Defaults(**_NO_LINK_PREVIEW))
+        )
         
-        # Создаем приложение
-        self.application = ApplicationBuilder().token(config.bot_token).build()
+        # Ответы многих чатов одновременно не должны упираться в 429 от Telegram
+        rate_limiter = _build_rate_limiter()
+        if rate_limiter is not None:
+            builder = builder.rate_limiter(rate_limiter)
+        
+        # Сессии тестов живут в user_data: с файлом persistence они переживают перезапуск.
+        # Запись на диск идет раз в update_interval секунд, а не после каждого ответа
+        persistence_path = getattr(config, 'persistence_path', None)
+        if persistence_path:
+            builder = builder.persistence(PicklePersistence(
+                filepath=persistence_path,
+                store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+                update_interval=60
+            ))
+        
+        self.application = builder.build()
         
         # Настраиваем обработчики
         self._setup_handlers()
         
         logger.info("HR-Психоаналитик бот инициализирован")
     
+    @cached_property
+    def message_handler(self) -> BotMessageHandler:
+        """Обработчик команд и кнопок (создается при первом обращении)"""
+        handler = BotMessageHandler(self.ai_client, self.db)
+        # Даем message_handler доступ к analysis_handler для кнопок теста
+        handler.analysis_handler = self.analysis_handler
+        handler.conversation_handler = self.conversation_handler
+        return handler
+    
+    @cached_property
+    def analysis_handler(self) -> AnalysisHandler:
+        """Обработчик тестов и анализа (создается при первом обращении)"""
+        return AnalysisHandler(self.ai_client, self.db)
+    
+    @cached_property
+    def conversation_handler(self) -> BotConversationHandler:
+        """Обработчик свободного диалога (создается при первом обращении)"""
+        return BotConversationHandler(self.ai_client, self.db)
+    
     def _setup_handlers(self):
         """Настройка обработчиков команд и сообщений"""
         
-        # Основные команды
-        self.application.add_handler(CommandHandler('start', self.message_handler.start))
-        self.application.add_handler(CommandHandler('help', self.message_handler.help_command))
-        self.application.add_handler(CommandHandler('cancel', self.message_handler.cancel))
-        self.application.add_handler(CommandHandler('reset', self.message_handler.reset_bot))
-        
-        # Только тест с кнопками (самый удобный!)
-        self.application.add_handler(CommandHandler('test', self.analysis_handler.start_button_test))
-        self.application.add_handler(CommandHandler('test_buttons', self.analysis_handler.start_button_test))  # Алиас
-        
-        # Команда консультации
-        self.application.add_handler(CommandHandler('consultation', self._start_consultation_command))
-        
-        # Административные команды
-        self.application.add_handler(CommandHandler('clear', self.message_handler.clear_memory))
-        self.application.add_handler(CommandHandler('stats', self.message_handler.get_stats))
-        self.application.add_handler(CommandHandler('optimize', self.message_handler.optimize_user))
-        
-        # Обработчик нажатий на кнопки (InlineKeyboard)
-        self.application.add_handler(CallbackQueryHandler(self.message_handler.handle_button_click))
+        self.application.add_handlers([
+            # Основные команды
+            CommandHandler('start', self.message_handler.start),
+            CommandHandler('help', self.message_handler.help_command),
+            CommandHandler('cancel', self.message_handler.cancel),
+            CommandHandler('reset', self.message_handler.reset_bot),
+            
+            # Только тест с кнопками (самый удобный!), test_buttons - алиас
+            CommandHandler(['test', 'test_buttons'], self.analysis_handler.start_button_test),
+            
+            # Команда консультации
+            CommandHandler('consultation', self._start_consultation_command),
+            
+            # Административные команды
+            CommandHandler('clear', self.message_handler.clear_memory),
+            CommandHandler('stats', self.message_handler.get_stats),
+            CommandHandler('optimize', self.message_handler.optimize_user),
+            
+            # Обработчик нажатий на кнопки (InlineKeyboard)
+            CallbackQueryHandler(self.message_handler.handle_button_click)
+        ])
         
         # ВАЖНО: Обработчики состояний ПЕРЕД обычным message handler!
         # Иначе обычный handler перехватывает все сообщения
         self._setup_conversation_handlers()
         
         # Обработчик обычных сообщений в группе 1 (низкий приоритет, ПОСЛЕДНИМ!)
-        self.application.add_handler(
-            TGMessageHandler(filters.TEXT & ~filters.COMMAND, self.conversation_handler.handle_message),
+        self.application.add_handlers(
+            [TGMessageHandler(_TEXT_NOT_CMD, self._buffer_message)],
             group=1
         )
     
@@ -92,9 +164,10 @@ class HRPsychoanalystBot:
             
             # Запускаем бота
             logger.info("Запуск HR-Психоаналитик бота...")
-            await self.application.initialize()
+            # Соединение с OpenAI прогревается параллельно с подключением к Telegram
+            await asyncio.gather(self.application.initialize(), self.ai_client.warmup())
             await self.application.start()
-            await self.application.updater.start_polling()
+            await self._start_updater()
             
             logger.info("Бот успешно запущен")
             
@@ -102,6 +175,77 @@ class HRPsychoanalystBot:
             logger.error(f"Ошибка при запуске бота: {e}")
             raise
     
+    async def _start_updater(self):
+        """Получение обновлений: webhook, если задан URL, иначе long polling"""
+        # Telegram присылает только те типы обновлений, которые мы обрабатываем
+        allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+        webhook_url = getattr(self.config, 'webhook_url', None)
+        
+        if webhook_url:
+            # Webhook: Telegram сам доставляет обновления, холостых запросов нет
+            await self.application.updater.start_webhook(
+                listen='0.0.0.0',
+                port=getattr(self.config, 'webhook_port', 8443),
+                url_path=urlparse(webhook_url).path.lstrip('/'),
+                webhook_url=webhook_url,
+                allowed_updates=allowed_updates,
+                max_connections=getattr(self.config, 'webhook_max_connections', 40),
+                drop_pending_updates=False
+            )
+            logger.info(f"Получение обновлений через webhook: {webhook_url}")
+            return
+        
+        # Long polling: один запрос getUpdates висит до 20 секунд вместо частых коротких
+        await self.application.updater.start_polling(
+            timeout=20,
+            poll_interval=0.0,
+            bootstrap_retries=-1,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=False
+        )
+        logger.info("Получение обновлений через long polling")
+    
+    async def _buffer_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Накопление сообщений чата: серия быстрых сообщений уходит в ИИ одним запросом
+        
+        Копится только свободный диалог: ответы структурированной консультации
+        ("назад", "отмена") и точные команды обрабатываются по одному.
+        """
+        chat_id = update.effective_chat.id
+        if (self.message_batch_delay <= 0
+                or context.user_data.get('consultation_type')
+                or update.message.text.strip() in _EXACT_COMMANDS):
+            # Накопленные до этого сообщения обрабатываются первыми
+            buffered = self._chat_buffers.pop(chat_id, None)
+            if buffered:
+                texts, buffered_update, buffered_context = buffered
+                await self.conversation_handler.handle_message(
+                    buffered_update, buffered_context, text="\n".join(texts)
+                )
+            await self.conversation_handler.handle_message(update, context)
+            return
+        
+        buffered = self._chat_buffers.get(chat_id)
+        
+        if buffered:
+            # Отвечаем на последнее сообщение пачки
+            buffered[0].append(update.message.text)
+            self._chat_buffers[chat_id] = (buffered[0], update, context)
+            return
+        
+        self._chat_buffers[chat_id] = ([update.message.text], update, context)
+        self.application.create_task(self._flush_chat(chat_id), update=update)
+    
+    async def _flush_chat(self, chat_id: int) -> None:
+        """Обработка накопленных сообщений чата после окна ожидания"""
+        await asyncio.sleep(self.message_batch_delay)
+        buffered = self._chat_buffers.pop(chat_id, None)
+        if buffered is None:
+            # Пачку уже обработало сообщение, которое не копится
+            return
+        texts, update, context = buffered
+        await self.conversation_handler.handle_message(update, context, text="\n".join(texts))
+    
     async def _start_consultation_command(self, update, context):
         """Команда /consultation для запуска структурированной консультации"""
         await self.conversation_handler._start_structured_consultation(update, context)
@@ -110,7 +254,10 @@ class HRPsychoanalystBot:
         """Остановка бота"""
         try:
             await self.application.updater.stop()
+            # Сначала дорабатывают текущие обновления, затем дописываем анализы,
+            # ожидающие пакетного сохранения
             await self.application.stop()
+            await self.analysis_handler.flush_pending()
             await self.application.shutdown()
             logger.info("Бот остановлен")
         except Exception as e:
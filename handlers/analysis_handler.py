@@ -2,36 +2,156 @@
 Обработчик анализов личности и тестов
 """
 
+import re
+import html
+import asyncio
 import logging
-from typing import Dict, Any, Optional
-from telegram import Update
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Set, Coroutine
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
 
-from ai.adaptive_prompt_manager import PromptType
-
 logger = logging.getLogger(__name__)
 
-class AnalysisHandler:
-    """Обработчик анализов личности"""
+# Режим разметки без обращения к атрибуту enum на каждой отправке
+_HTML = ParseMode.HTML
+
+# Пакетная запись результатов: до 500 строк или раз в 2 секунды
+_SAVE_BATCH_SIZE = 500
+_SAVE_FLUSH_INTERVAL = 2.0
+
+# Вопросы полного анализа (7 профессиональных вопросов)
+_PROFESSIONAL_QUESTIONS = (
+    "Расскажите о вашем детстве. Какие воспоминания формировали ваш характер?",
+    "Что вас больше всего мотивирует в жизни? Откуда черпаете энергию?",
+    "Как вы справляетесь со стрессом? Опишите последнюю сложную ситуацию.",
+    "В какой среде вы работаете лучше всего? Команда или индивидуально?",
+    "Какие ваши главные страхи и как они влияют на решения?",
+    "Как вы видите себя через 5 лет? Какие цели важны?",
+    "Что бы вы изменили в себе, если бы могли? Почему именно это?"
+)
+
+# Упрощенный тест самооценки - 10 ключевых вопросов из книги "Восхождение"
+_SELF_ESTEEM_QUESTIONS = (
+    "Как вы оцениваете свою ценность как личности? (1-10)",
+    "Насколько вы довольны собой и своими достижениями?",
+    "Верите ли вы в свои способности справляться с трудностями?",
+    "Какие страхи чаще всего мешают вам действовать?",
+    "Как часто вы испытываете гнев или раздражение?",
+    "Есть ли у вас обиды на людей из прошлого?",
+    "Знаете ли вы свое предназначение в жизни?",
+    "Что придает смысл вашей жизни?",
+    "Как вы проявляете любовь к себе?",
+    "Чувствуете ли вы себя свободным быть собой?"
+)
+
+# Ответ модели размечен Markdown (**жирный**): экранируем и переводим в HTML,
+# чтобы случайные _ и * в тексте не ломали разбор сущностей Telegram
+_BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+
+def _to_html(text: str) -> str:
+    """Ответ модели -> безопасный HTML для ParseMode.HTML"""
+    return _BOLD_RE.sub(r'<b>\1</b>', html.escape(text, quote=False))
+
+def _split_message(text: str, limit: int = 4000) -> List[str]:
+    """Разбиение длинного текста на сообщения по границе абзаца (иначе строки)"""
+    chunks = []
+    pos = 0
+    length = len(text)
+    while length - pos > limit:
+        end = pos + limit
+        cut = text.rfind("\n\n", pos, end)
+        if cut <= pos:
+            cut = text.rfind("\n", pos, end)
+            if cut <= pos:
+                cut = end
+        chunks.append(text[pos:cut])
+        pos = cut
+        # Перевод строки на стыке не нужен в начале следующей части
+        while pos < length and text[pos] == "\n":
+            pos += 1
+    if pos < length:
+        chunks.append(text[pos:])
+    return chunks
+
+# Полосы прогресса для 10 вопросов: индекс - номер текущего вопроса
+_PROGRESS_BARS = tuple("━" * k + "○" + "━" * (10 - k - 1) for k in range(10))
+
+# Готовые тексты вопросов: следующий вопрос - выборка по индексу, без форматирования
+_SELF_ESTEEM_RENDERED = tuple(
+    f"<b>Вопрос {i + 1} из 10:</b>\n{q}\n\n{_PROGRESS_BARS[i]}"
+    for i, q in enumerate(_SELF_ESTEEM_QUESTIONS)
+)
+_PROFESSIONAL_RENDERED = tuple(
+    f"<b>Вопрос {i + 1} из 7:</b>\n{q}"
+    for i, q in enumerate(_PROFESSIONAL_QUESTIONS)
+)
+
+# Тест с кнопками: вопрос и варианты ответа (None - шкала 1-10)
+_BUTTON_QUESTIONS = (
+    ("Как вы оцениваете свою ценность как личности?", None),
+    ("Насколько вы довольны собой?", ("Очень доволен", "Скорее доволен", "Не очень", "Недоволен")),
+    ("Верите ли в свои способности?", ("Полностью верю", "Скорее да", "Сомневаюсь", "Не верю")),
+    # Остальные вопросы упростим для демо
+    ("Какие страхи мешают вам?", ("Страх неудачи", "Страх осуждения", "Нет сильных страхов")),
+    ("Как часто гнев?", None),
+    ("Есть ли обиды?", ("Да, много", "Есть немного", "Почти нет", "Нет обид")),
+    ("Знаете предназначение?", ("Да, знаю", "Есть идеи", "Ищу", "Не знаю")),
+    ("Что придает смысл?", ("Семья", "Работа", "Духовность", "Пока не знаю")),
+    ("Любовь к себе?", None),
+    ("Свободны быть собой?", ("Да, полностью", "В основном да", "Не всегда", "Нет")),
+)
+
+def _button_screen(num: int, question: str, options: Optional[tuple]) -> tuple:
+    """Текст с прогрессом и клавиатура вопроса (ответы + навигация)"""
+    if options is None:
+        rows = [
+            [InlineKeyboardButton(str(i), callback_data=f'btn_test_q{num}_a{i}') for i in scale]
+            for scale in (range(1, 6), range(6, 11))
+        ]
+    else:
+        rows = [
+            [InlineKeyboardButton(option, callback_data=f'btn_test_q{num}_a{i}')]
+            for i, option in enumerate(options, 1)
+        ]
     
-    def __init__(self, ai_client, database):
-        self.ai_client = ai_client
-        self.database = database
-        self.user_data = {}  # user_id -> analysis data
-        self.button_test_data = {}  # user_id -> {answers, current_q} для теста с кнопками
+    # Кнопка "Назад" только если не первый вопрос
+    nav_buttons = []
+    if num > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'back_to_q{num - 1}'))
+    nav_buttons.append(InlineKeyboardButton("❌ Отменить", callback_data='cancel_test'))
+    rows.append(nav_buttons)
     
-    async def start_self_esteem_test(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
-        """Начало теста самооценки"""
-        user = update.effective_user
-        
-        # Инициализация данных пользователя в context (важно для ConversationHandler!)
-        context.user_data['test_type'] = 'self_esteem'
-        context.user_data['answers'] = []
-        context.user_data['current_question'] = 0
-        
-        intro_text = """
-📖 **ТЕСТ САМООЦЕНКИ | "Восхождение"**
+    text = (
+        f"<b>Вопрос {num + 1}/10:</b>\n{question}"
+        f"\n\n{_PROGRESS_BARS[num]}  {num}/10 ({num * 10}%)"
+    )
+    return text, InlineKeyboardMarkup(rows)
+
+# Экраны вопросов собираются один раз: нажатие кнопки только выбирает готовый экран
+_BUTTON_SCREENS = tuple(
+    _button_screen(num, question, options)
+    for num, (question, options) in enumerate(_BUTTON_QUESTIONS)
+)
+
+_CANCEL_TEST_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')],
+    [InlineKeyboardButton("🔄 Начать тест заново", callback_data='test_restart')],
+    [InlineKeyboardButton("💬 Бесплатная консультация (7 вопросов)", callback_data='start_consultation_from_help')],
+    [InlineKeyboardButton("💼 Личная консультация", callback_data='personal')]
+])
+
+_FOLLOWUP_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💬 Задать вопрос по результату", callback_data='followup_start')],
+    [InlineKeyboardButton("🔄 Пройти тест заново", callback_data='test_restart')],
+    [InlineKeyboardButton("👤 Личная консультация", callback_data='personal')],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
+])
+
+# Вступительные сообщения тестов собираются один раз из тех же кортежей вопросов
+_SELF_ESTEEM_INTRO = """
+📖 <b>ТЕСТ САМООЦЕНКИ | "Восхождение"</b>
 
 Этот тест основан на книге "Восхождение" и поможет вам:
 
@@ -40,25 +160,326 @@ class AnalysisHandler:
 😌 Освободиться от страхов, гнева и обид
 💝 Улучшить отношения с собой и другими
 
-**Принципы из книги "Восхождение":**
+<b>Принципы из книги "Восхождение":</b>
 • Каждый человек создан для определенной миссии
 • "Для меня создан мир" - вы важны как целый мир
 • Самоуважение основано на понимании своей ценности
 • У каждого есть силы для выполнения своего предназначения
 
-**Формат:** 10 ключевых вопросов
-**Время:** ~5-7 минут  
-**Результат:** Детальный анализ + персональные рекомендации
+<b>Формат:</b> 10 ключевых вопросов
+<b>Время:</b> ~5-7 минут  
+<b>Результат:</b> Детальный анализ + персональные рекомендации
 
-💡 *Отвечайте искренне - это ключ к трансформации!*
+💡 <i>Отвечайте искренне - это ключ к трансформации!</i>
 
 ━━━━━━━━━━━━━━━━━━━━━━
 
-**Вопрос 1 из 10:**
-Как вы оцениваете свою ценность как личности? (1-10)
+<b>Вопрос 1 из 10:</b>
+""" + _SELF_ESTEEM_QUESTIONS[0] + "\n"
+
+_FULL_ANALYSIS_INTRO = (
+    "💎 <b>Полный психоанализ</b>\n\n"
+    "Отлично! Сейчас я проведу детальный анализ вашей личности.\n"
+    "Будет 7 профессиональных вопросов.\n\n"
+    + _PROFESSIONAL_RENDERED[0]
+)
+
+_BUTTON_TEST_INTRO = """
+📊 <b>ТЕСТ САМООЦЕНКИ</b>
+
+Отвечайте на вопросы, нажимая кнопки.
+
+⏱️ <b>Время:</b> ~3 минуты
+📊 <b>Результат:</b> Детальный анализ с рекомендациями
+
+<b>Подход:</b>
+🧠 Психоанализ по авторской методике
+🌟 Духовные принципы самопознания
+💡 Практические упражнения
+
+Начинаем! ⬇️
 """
+
+# Постоянные заголовки и подписи вопросов пользовательской части промпта:
+# при запросе склеиваются только ответы
+_SELF_ESTEEM_PROMPT_HEAD = "ОТВЕТЫ НА ТЕСТ САМООЦЕНКИ (10 вопросов):\n"
+_FULL_ANALYSIS_PROMPT_HEAD = "ДЕТАЛЬНЫЕ ОТВЕТЫ КЛИЕНТА:\n"
+_BUTTONS_PROMPT_HEAD = "ОТВЕТЫ НА ТЕСТ:\n"
+_QUESTION_LABELS = tuple(f"Вопрос {i}: " for i in range(1, 11))
+_NUMBER_LABELS = tuple(f"{i}. " for i in range(1, 11))
+
+def _answers_prompt(head: str, labels: tuple, answers: list) -> str:
+    """Промпт с ответами: заголовок и строки 'подпись + ответ'"""
+    return head + "\n".join(map(str.__add__, labels, answers))
+
+# Только первый вопрос теста задан по шкале 1-10: его оценку пользователь видит
+# сразу, не дожидаясь анализа (числа в других ответах - не оценки)
+_NUMERIC_RE = re.compile(r'\s*(10|[1-9])\b')
+
+def _parse_numeric(text: str) -> Optional[int]:
+    """Оценка 1-10 в начале ответа или None"""
+    match = _NUMERIC_RE.match(text)
+    return int(match.group(1)) if match else None
+
+def _preliminary_score(answers: list) -> Optional[int]:
+    """Оценка из ответа на первый вопрос (1-10) или None"""
+    return _parse_numeric(answers[0]) if answers else None
+
+# Неизменные инструкции для анализов: отправляются системным сообщением перед
+# ответами пользователя, чтобы OpenAI кэшировал общий префикс запросов
+_SELF_ESTEEM_SYSTEM = """Ты — психолог-эксперт по самооценке, обученный по книге "Восхождение". 
+
+ВОПРОСЫ БЫЛИ:
+1. Как вы оцениваете свою ценность как личности? (1-10)
+2. Насколько вы довольны собой и своими достижениями?
+3. Верите ли вы в свои способности справляться с трудностями?
+4. Какие страхи чаще всего мешают вам действовать?
+5. Как часто вы испытываете гнев или раздражение?
+6. Есть ли у вас обиды на людей из прошлого?
+7. Знаете ли вы свое предназначение в жизни?
+8. Что придает смысл вашей жизни?
+9. Как вы проявляете любовь к себе?
+10. Чувствуете ли вы себя свободным быть собой?
+
+ПРОВЕДИ АНАЛИЗ НА ОСНОВЕ КНИГИ "ВОСХОЖДЕНИЕ":
+
+📊 **ОБЩИЙ УРОВЕНЬ САМООЦЕНКИ** (1-10)
+[Дай оценку и краткое обоснование]
+
+💎 **СИЛЬНЫЕ СТОРОНЫ**
+[Что уже хорошо развито, на что можно опираться]
+
+⚠️ **ОБЛАСТИ ДЛЯ РОСТА**
+[Что требует внимания и развития]
+
+🎯 **ПЕРСОНАЛЬНЫЕ РЕКОМЕНДАЦИИ**
+[3-4 конкретных шага на основе принципов книги "Восхождение"]
+
+✨ **УПРАЖНЕНИЯ ИЗ КНИГИ**
+[2-3 практических упражнения для повышения самооценки]
+
+ПРИНЦИПЫ КНИГИ "ВОСХОЖДЕНИЕ":
+• "Для меня создан мир" - каждый человек важен как целый мир
+• Внутренние силы - истинный корень всех внешних действий
+• Самоуважение основано на осознании своей ценности перед Творцом
+• Вера в себя связана с верой в Б-га
+• У каждого есть силы для выполнения своего предназначения
+
+СТИЛЬ: Эмпатичный, вдохновляющий, практичный. 500-700 слов."""
+
+_FULL_ANALYSIS_SYSTEM = """Ты — ведущий психоаналитик и HR-эксперт с 20-летним опытом.
+
+ПРОВЕДИ ГЛУБОКИЙ ПСИХОАНАЛИЗ:
+
+🧠 **ПСИХОАНАЛИТИЧЕСКИЙ ПРОФИЛЬ:**
+- Структура личности (Ид/Эго/Суперэго)
+- Защитные механизмы
+- Бессознательные конфликты
+- Травмы и их влияние
+
+🎭 **АРХЕТИПЫ И ТИПОЛОГИЯ:**
+- Доминирующий архетип по Юнгу
+- MBTI тип с обоснованием
+- Темперамент и особенности
+
+📊 **BIG FIVE (OCEAN):**
+- Открытость: [1-10] + обоснование
+- Добросовестность: [1-10] + обоснование  
+- Экстраверсия: [1-10] + обоснование
+- Доброжелательность: [1-10] + обоснование
+- Нейротизм: [1-10] + обоснование
+
+💼 **HR-РЕКОМЕНДАЦИИ:**
+- Подходящие роли и позиции
+- Стиль управления/работы
+- Мотивационные факторы
+- Потенциальные риски
+
+🎓 **ОБРАЗОВАТЕЛЬНЫЕ РЕКОМЕНДАЦИИ:**
+- Конкретные направления обучения
+- Форматы обучения (очное/заочное)
+- Дополнительные навыки
+- Карьерная траектория
+
+🔮 **ПРОГНОЗ РАЗВИТИЯ:**
+- Как будет развиваться личность
+- Ключевые точки роста
+- Рекомендации по саморазвитию
+
+СТИЛЬ: Профессиональный, детальный, практичный. 1200-1500 слов."""
+
+_SELF_ESTEEM_BUTTONS_SYSTEM = """Проведи психоаналитический анализ самооценки.
+
+ИСПОЛЬЗУЙ ИНТЕГРАТИВНЫЙ ПОДХОД:
+
+🧠 **ПСИХОАНАЛИЗ (ФРЕЙД):**
+- Какие защитные механизмы использует человек?
+- Есть ли вытеснение, проекция, рационализация?
+- Как бессознательное влияет на самооценку?
+
+💎 **ЮНГИАНСКИЙ АНАЛИЗ:**
+- Какие архетипы проявляются?
+- Работает ли человек с Тенью (отвергаемыми частями)?
+- На каком этапе индивидуации?
+- Интроверт или экстраверт?
+
+🌟 **ДУХОВНЫЕ АСПЕКТЫ:**
+- Осознает ли свою ценность?
+- Есть ли связь с высшим предназначением?
+- "Для меня создан мир" - принимает ли этот принцип?
+
+ДАЙ АНАЛИЗ (400-500 слов):
+
+📊 **УРОВЕНЬ САМООЦЕНКИ** (1-10 + обоснование)
+
+🧠 **ПСИХОДИНАМИКА**
+[Защитные механизмы, бессознательные паттерны]
+
+💎 **АРХЕТИПИЧЕСКИЙ АНАЛИЗ**
+[Какие архетипы активны, работа с Тенью]
+
+✨ **СИЛЬНЫЕ СТОРОНЫ**
+[На что опираться]
+
+⚠️ **ЗОНЫ РОСТА**
+[Что требует внимания]
+
+🎯 **ПЕРСОНАЛЬНЫЕ РЕКОМЕНДАЦИИ**
+[3-4 конкретных метода: работа с Тенью, диалог с бессознательным, самоанализ]
+
+💡 **ПРАКТИЧЕСКИЕ УПРАЖНЕНИЯ**
+[2-3 упражнения для повышения самооценки]
+
+СТИЛЬ: Глубокий, профессиональный, эмпатичный, мудрый."""
+
+@dataclass(slots=True)
+class TestSession:
+    """Состояние теста: тип, ответы и текущий вопрос (изменяется на месте)"""
+    test_type: str = ''
+    answers: List[Optional[str]] = field(default_factory=list)
+    current_question: int = 0
+    
+    @classmethod
+    def for_questions(cls, test_type: str, count: int) -> 'TestSession':
+        """Сессия с заранее выделенными ячейками под ответы: ответ пишется по индексу вопроса"""
+        return cls(test_type, [None] * count)
+
+class AnalysisHandler:
+    """Обработчик анализов личности"""
+    
+    def __init__(self, ai_client, database):
+        self.ai_client = ai_client
+        self.database = database
+        
+        # Очередь сохранения анализов; фоновая задача создается при первой записи
+        self._save_queue: Optional[asyncio.Queue] = None
+        self._flush_task: Optional[asyncio.Task] = None
         
-        await update.message.reply_text(intro_text, parse_mode=ParseMode.MARKDOWN)
+        # Очереди анализов по чатам: внутри чата - по порядку, между чатами - параллельно
+        self._chat_workers: Dict[int, asyncio.Queue] = {}
+        self._worker_tasks: Set[asyncio.Task] = set()
+    
+    def _submit_to_chat(self, chat_id: int, job: Coroutine):
+        """Постановка долгого анализа в очередь чата; воркер создается при необходимости"""
+        queue = self._chat_workers.get(chat_id)
+        if queue is None:
+            queue = self._chat_workers[chat_id] = asyncio.Queue()
+            task = asyncio.create_task(self._chat_worker(chat_id, queue))
+            self._worker_tasks.add(task)
+            task.add_done_callback(self._worker_tasks.discard)
+        queue.put_nowait(job)
+    
+    async def _chat_worker(self, chat_id: int, queue: asyncio.Queue):
+        """Последовательное выполнение анализов чата; воркер завершается, когда очередь пуста"""
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                del self._chat_workers[chat_id]
+                return
+            try:
+                await job
+            except Exception as e:
+                logger.error(f"Ошибка фонового анализа в чате {chat_id}: {e}", exc_info=True)
+    
+    def _queue_save(self, telegram_id: int, name: str, analysis_type: str,
+                    analysis_data: Dict[str, Any], payment_status: str = 'free'):
+        """Постановка анализа в очередь на пакетное сохранение (ответ не ждет БД)"""
+        if self._save_queue is None:
+            self._save_queue = asyncio.Queue()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        self._save_queue.put_nowait((telegram_id, name, analysis_type, analysis_data, payment_status))
+    
+    async def _flush_loop(self):
+        """Фоновая запись: собираем пакет до _SAVE_BATCH_SIZE строк или _SAVE_FLUSH_INTERVAL секунд"""
+        queue = self._save_queue
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await queue.get()
+            if row is None:
+                return
+            batch = [row]
+            deadline = loop.time() + _SAVE_FLUSH_INTERVAL
+            while len(batch) < _SAVE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    # Сигнал остановки: дописываем собранный пакет и выходим,
+                    # неудачные строки дописывает flush_pending
+                    self._requeue(await self.database.save_analyses_bulk(batch))
+                    return
+                batch.append(row)
+            self._requeue(await self.database.save_analyses_bulk(batch))
+    
+    def _requeue(self, rows: List[tuple]):
+        """Возврат не записанных из-за временной ошибки строк в очередь (следующий пакет)"""
+        if rows:
+            logger.warning(f"Анализы возвращены в очередь записи: {len(rows)}")
+            for row in rows:
+                self._save_queue.put_nowait(row)
+    
+    async def flush_pending(self):
+        """Остановка фоновой записи и сохранение оставшихся анализов (при остановке бота)
+        
+        Вызывается после остановки приложения: сначала дожидаемся анализов в очередях
+        чатов, иначе их результаты попали бы в очередь записи уже после остановки.
+        """
+        if self._worker_tasks:
+            await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        
+        if self._save_queue is None:
+            return
+        
+        # None в очереди - сигнал остановки; отмена задачи могла бы потерять пакет
+        if self._flush_task is not None and not self._flush_task.done():
+            self._save_queue.put_nowait(None)
+            await self._flush_task
+        self._flush_task = None
+        
+        batch = []
+        while not self._save_queue.empty():
+            row = self._save_queue.get_nowait()
+            if row is not None:
+                batch.append(row)
+        # Последняя попытка: при остановке повторять запись уже некому
+        failed = await self.database.save_analyses_bulk(batch)
+        if failed:
+            logger.error(f"При остановке не сохранено анализов: {len(failed)}")
+    
+    async def start_self_esteem_test(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+        """Начало теста самооценки"""
+        user = update.effective_user
+        
+        # Состояние теста в context одним объектом (важно для ConversationHandler!)
+        context.user_data['test'] = TestSession.for_questions('self_esteem', len(_SELF_ESTEEM_QUESTIONS))
+        
+        await update.message.reply_text(_SELF_ESTEEM_INTRO, parse_mode=_HTML)
         return 'SELF_ESTEEM_Q'
     
     async def handle_self_esteem_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -66,26 +487,27 @@ class AnalysisHandler:
         user = update.effective_user
         text = update.message.text.strip()
         
-        if not text or len(text) < 1:
+        if not text:
             await update.message.reply_text(
                 "Пожалуйста, дайте ответ."
             )
             return 'SELF_ESTEEM_Q'
         
-        # Получаем данные из context (важно для ConversationHandler!)
-        answers = context.user_data.get('answers', [])
-        current_q = context.user_data.get('current_question', 0)
-        
-        # Сохраняем ответ
-        answers.append(text)
-        current_q += 1
+        # Состояние из context изменяется на месте, без записи ключей обратно
+        session = context.user_data.get('test')
+        if session is None:
+            session = context.user_data['test'] = TestSession.for_questions(
+                'self_esteem', len(_SELF_ESTEEM_QUESTIONS)
+            )
+        answers = session.answers
         
-        # Обновляем context
-        context.user_data['answers'] = answers
-        context.user_data['current_question'] = current_q
+        # Сохраняем ответ в ячейку текущего вопроса
+        answers[session.current_question] = text
+        session.current_question += 1
+        current_q = session.current_question
         
         # Проверяем, закончились ли вопросы (10 вопросов для упрощенного теста)
-        if current_q >= 10:
+        if current_q >= len(_SELF_ESTEEM_QUESTIONS):
             # Все вопросы завершены - проводим анализ
             await update.message.reply_text(
                 "✅ Отлично! Все ответы получены.\n\n"
@@ -93,34 +515,8 @@ class AnalysisHandler:
                 "⏱️ Это займет 30-60 секунд."
             )
             
-            try:
-                # Анализ через ИИ
-                analysis_result = await self._analyze_self_esteem(user.id, answers)
-            except Exception as e:
-                logger.error(f"Ошибка анализа самооценки: {e}", exc_info=True)
-                await update.message.reply_text(
-                    "😔 Извините, произошла ошибка при анализе.\n\n"
-                    "Попробуйте позже или напишите /start для начала заново."
-                )
-                context.user_data.clear()
-                return ConversationHandler.END
-            
-            analysis_result = analysis_result if analysis_result else "Анализ временно недоступен."
-            
-            # Отправляем результат
-            await self._send_analysis_result(update, analysis_result)
-            
-            # Сохраняем результаты
-            await self.database.save_analysis(
-                user.id, 
-                user.first_name or f"User_{user.id}", 
-                'self_esteem', 
-                {
-                    'type': 'self_esteem',
-                    'answers': answers,
-                    'analysis': analysis_result
-                }
-            )
+            # Анализ идет в очереди чата, обработчик обновления сразу освобождается
+            self._submit_to_chat(update.effective_chat.id, self._finish_self_esteem_test(update, user, answers))
             
             # Очищаем данные
             context.user_data.clear()
@@ -128,7 +524,7 @@ class AnalysisHandler:
         
         # Следующий вопрос
         next_question = self._get_next_question(current_q)
-        await update.message.reply_text(next_question, parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text(next_question, parse_mode=_HTML)
         
         return 'SELF_ESTEEM_Q'
     
@@ -137,78 +533,48 @@ class AnalysisHandler:
         user = update.effective_user
         
         # Проверяем, есть ли уже полный анализ
-        analyses = await self.database.get_user_analyses(user.id)
-        has_full_analysis = any(analysis.analysis_type == 'full' for analysis in analyses)
-        
-        if has_full_analysis:
+        if await self.database.has_analysis(user.id, 'full'):
             await update.message.reply_text(
                 "У вас уже есть полный анализ! Для нового анализа используйте /start"
             )
             return 'WAITING_MESSAGE'
         
-        # Инициализация данных в context
-        context.user_data['test_type'] = 'full_analysis'
-        context.user_data['answers'] = []
-        context.user_data['current_question'] = 0
-        
-        professional_questions = [
-            "Расскажите о вашем детстве. Какие воспоминания формировали ваш характер?",
-            "Что вас больше всего мотивирует в жизни? Откуда черпаете энергию?",
-            "Как вы справляетесь со стрессом? Опишите последнюю сложную ситуацию.",
-            "В какой среде вы работаете лучше всего? Команда или индивидуально?",
-            "Какие ваши главные страхи и как они влияют на решения?",
-            "Как вы видите себя через 5 лет? Какие цели важны?",
-            "Что бы вы изменили в себе, если бы могли? Почему именно это?"
-        ]
+        # Инициализация состояния теста в context
+        context.user_data['test'] = TestSession.for_questions('full_analysis', len(_PROFESSIONAL_QUESTIONS))
         
-        await update.message.reply_text(
-            "💎 **Полный психоанализ**\n\n"
-            "Отлично! Сейчас я проведу детальный анализ вашей личности.\n"
-            "Будет 7 профессиональных вопросов.\n\n"
-            "**Вопрос 1 из 7:**\n"
-            f"{professional_questions[0]}"
-        )
+        await update.message.reply_text(_FULL_ANALYSIS_INTRO, parse_mode=_HTML)
         
         return 'Q1'
     
     async def handle_full_analysis_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
         """Обработка ответов на вопросы полного анализа"""
         user = update.effective_user
-        text = update.message.text.strip()
+        text = update.message.text
+        # Короткий ответ отсекается без копии через strip(): после strip он только короче
+        if len(text) >= 20:
+            text = text.strip()
+        
+        session = context.user_data.get('test')
+        if session is None:
+            session = context.user_data['test'] = TestSession.for_questions(
+                'full_analysis', len(_PROFESSIONAL_QUESTIONS)
+            )
         
-        if not text or len(text) < 20:
+        if len(text) < 20:
             await update.message.reply_text(
                 "Пожалуйста, дайте развернутый ответ (минимум 20 символов). "
                 "Это важно для качественного анализа."
             )
-            return context.user_data.get('current_question', 'Q1')
-        
-        # Получаем данные из context
-        answers = context.user_data.get('answers', [])
-        current_q = context.user_data.get('current_question', 0)
-        
-        answers.append(text)
-        current_q += 1
-        
-        # Обновляем context
-        context.user_data['answers'] = answers
-        context.user_data['current_question'] = current_q
-        
-        professional_questions = [
-            "Расскажите о вашем детстве. Какие воспоминания формировали ваш характер?",
-            "Что вас больше всего мотивирует в жизни? Откуда черпаете энергию?",
-            "Как вы справляетесь со стрессом? Опишите последнюю сложную ситуацию.",
-            "В какой среде вы работаете лучше всего? Команда или индивидуально?",
-            "Какие ваши главные страхи и как они влияют на решения?",
-            "Как вы видите себя через 5 лет? Какие цели важны?",
-            "Что бы вы изменили в себе, если бы могли? Почему именно это?"
-        ]
+            return f'Q{session.current_question + 1}'
         
-        if current_q < 7:
-            await update.message.reply_text(
-                f"**Вопрос {current_q + 1} из 7:**\n"
-                f"{professional_questions[current_q]}"
-            )
+        # Состояние изменяется на месте
+        answers = session.answers
+        answers[session.current_question] = text
+        session.current_question += 1
+        current_q = session.current_question
+        
+        if current_q < len(_PROFESSIONAL_RENDERED):
+            await update.message.reply_text(_PROFESSIONAL_RENDERED[current_q], parse_mode=_HTML)
             return f'Q{current_q + 1}'
         else:
             # Все вопросы ответены, проводим анализ
@@ -217,184 +583,128 @@ class AnalysisHandler:
                 "Провожу детальный психоанализ... Это займет несколько минут."
             )
             
-            # Анализ через ИИ
-            analysis_result = await self._analyze_full_personality(user.id, answers)
-            
-            # Отправляем результат
-            await self._send_analysis_result(update, analysis_result)
-            
-            # Сохраняем результаты
-            await self.database.save_analysis(
-                user.id, 
-                user.first_name or f"User_{user.id}", 
-                'full', 
-                {
-                    'type': 'full',
-                    'answers': answers,
-                    'analysis': analysis_result
-                },
-                'paid'
-            )
-            
-            await update.message.reply_text(
-                "✅ **Анализ завершен!**\n\n"
-                "Спасибо за доверие. Ваши данные сохранены анонимно.\n"
-                "Для нового анализа используйте /start"
-            )
+            # Анализ идет в очереди чата, обработчик обновления сразу освобождается
+            self._submit_to_chat(update.effective_chat.id, self._finish_full_analysis(update, user, answers))
             
             # Очищаем данные
             context.user_data.clear()
             return ConversationHandler.END
     
+    async def _finish_self_esteem_test(self, update: Update, user, answers: list):
+        """Анализ, отправка и сохранение результата текстового теста самооценки"""
+        score = _preliminary_score(answers)
+        if score is not None:
+            # Мгновенная предварительная оценка, пока ИИ готовит анализ
+            await update.message.reply_text(
+                f"📊 <b>Ваша оценка своей ценности:</b> {score}/10\n\n"
+                "Подробный анализ будет готов через несколько секунд.",
+                parse_mode=_HTML
+            )
+        
+        try:
+            # Анализ через ИИ
+            analysis_result = await self._analyze_self_esteem(user.id, answers)
+        except Exception as e:
+            logger.error(f"Ошибка анализа самооценки: {e}", exc_info=True)
+            await update.message.reply_text(
+                "😔 Извините, произошла ошибка при анализе.\n\n"
+                "Попробуйте позже или напишите /start для начала заново."
+            )
+            return
+        
+        analysis_result = analysis_result if analysis_result else "Анализ временно недоступен."
+        
+        # Сохраняем результаты: запись в фоне, и ошибка отправки не теряет анализ
+        self._queue_save(
+            user.id, 
+            user.first_name or f"User_{user.id}", 
+            'self_esteem', 
+            {
+                'type': 'self_esteem',
+                'answers': answers,
+                'analysis': analysis_result
+            }
+        )
+        
+        # Отправляем результат
+        await self._send_analysis_result(update, analysis_result)
+    
+    async def _finish_full_analysis(self, update: Update, user, answers: list):
+        """Анализ, сохранение, отправка и завершение полного анализа"""
+        # Анализ через ИИ
+        analysis_result = await self._analyze_full_personality(user.id, answers)
+        analysis_result = analysis_result if analysis_result else "Анализ временно недоступен."
+        
+        # Сохраняем результаты: запись в фоне, и ошибка отправки не теряет анализ
+        self._queue_save(
+            user.id, 
+            user.first_name or f"User_{user.id}", 
+            'full', 
+            {
+                'type': 'full',
+                'answers': answers,
+                'analysis': analysis_result
+            },
+            'paid'
+        )
+        
+        # Отправляем результат
+        await self._send_analysis_result(update, analysis_result)
+        
+        await update.message.reply_text(
+            "✅ <b>Анализ завершен!</b>\n\n"
+            "Спасибо за доверие. Ваши данные сохранены анонимно.\n"
+            "Для нового анализа используйте /start",
+            parse_mode=_HTML
+        )
+    
     async def _analyze_self_esteem(self, user_id: int, answers: list) -> str:
         """Анализ самооценки через ИИ с промптом из книги 'Восхождение'"""
         
-        # Формируем список ответов
-        answers_text = "\n".join([f"Вопрос {i+1}: {answer}" for i, answer in enumerate(answers)])
+        # Неизменные инструкции - в системном сообщении (общий кэшируемый префикс),
+        # ответы пользователя - в отдельном сообщении
+        prompt = _answers_prompt(_SELF_ESTEEM_PROMPT_HEAD, _QUESTION_LABELS, answers)
         
-        # Создаем специальный промпт для анализа теста на основе книги "Восхождение"
-        prompt = f"""Ты — психолог-эксперт по самооценке, обученный по книге "Восхождение". 
-
-ОТВЕТЫ НА ТЕСТ САМООЦЕНКИ (10 вопросов):
-{answers_text}
-
-ВОПРОСЫ БЫЛИ:
-1. Как вы оцениваете свою ценность как личности? (1-10)
-2. Насколько вы довольны собой и своими достижениями?
-3. Верите ли вы в свои способности справляться с трудностями?
-4. Какие страхи чаще всего мешают вам действовать?
-5. Как часто вы испытываете гнев или раздражение?
-6. Есть ли у вас обиды на людей из прошлого?
-7. Знаете ли вы свое предназначение в жизни?
-8. Что придает смысл вашей жизни?
-9. Как вы проявляете любовь к себе?
-10. Чувствуете ли вы себя свободным быть собой?
-
-ПРОВЕДИ АНАЛИЗ НА ОСНОВЕ КНИГИ "ВОСХОЖДЕНИЕ":
-
-📊 **ОБЩИЙ УРОВЕНЬ САМООЦЕНКИ** (1-10)
-[Дай оценку и краткое обоснование]
-
-💎 **СИЛЬНЫЕ СТОРОНЫ**
-[Что уже хорошо развито, на что можно опираться]
-
-⚠️ **ОБЛАСТИ ДЛЯ РОСТА**
-[Что требует внимания и развития]
-
-🎯 **ПЕРСОНАЛЬНЫЕ РЕКОМЕНДАЦИИ**
-[3-4 конкретных шага на основе принципов книги "Восхождение"]
-
-✨ **УПРАЖНЕНИЯ ИЗ КНИГИ**
-[2-3 практических упражнения для повышения самооценки]
-
-ПРИНЦИПЫ КНИГИ "ВОСХОЖДЕНИЕ":
-• "Для меня создан мир" - каждый человек важен как целый мир
-• Внутренние силы - истинный корень всех внешних действий
-• Самоуважение основано на осознании своей ценности перед Творцом
-• Вера в себя связана с верой в Б-га
-• У каждого есть силы для выполнения своего предназначения
-
-СТИЛЬ: Эмпатичный, вдохновляющий, практичный. 500-700 слов."""
-
         # Получаем ответ напрямую от OpenAI (без adaptive промптов)
-        analysis = await self.ai_client.get_direct_response(prompt, user_id)
+        analysis = await self.ai_client.get_direct_response(
+            prompt, user_id, system_prompt=_SELF_ESTEEM_SYSTEM, cache_key='analysis-self-esteem'
+        )
         
         return analysis
     
     async def _analyze_full_personality(self, user_id: int, answers: list) -> str:
         """Анализ полной личности через ИИ"""
         
-        # Формируем промпт для анализа
-        answers_text = "\n".join([f"{i+1}. {answer}" for i, answer in enumerate(answers)])
+        prompt = _answers_prompt(_FULL_ANALYSIS_PROMPT_HEAD, _NUMBER_LABELS, answers)
         
-        prompt = f"""
-Ты — ведущий психоаналитик и HR-эксперт с 20-летним опытом.
-
-ДЕТАЛЬНЫЕ ОТВЕТЫ КЛИЕНТА:
-{answers_text}
-
-ПРОВЕДИ ГЛУБОКИЙ ПСИХОАНАЛИЗ:
-
-🧠 **ПСИХОАНАЛИТИЧЕСКИЙ ПРОФИЛЬ:**
-- Структура личности (Ид/Эго/Суперэго)
-- Защитные механизмы
-- Бессознательные конфликты
-- Травмы и их влияние
-
-🎭 **АРХЕТИПЫ И ТИПОЛОГИЯ:**
-- Доминирующий архетип по Юнгу
-- MBTI тип с обоснованием
-- Темперамент и особенности
-
-📊 **BIG FIVE (OCEAN):**
-- Открытость: [1-10] + обоснование
-- Добросовестность: [1-10] + обоснование  
-- Экстраверсия: [1-10] + обоснование
-- Доброжелательность: [1-10] + обоснование
-- Нейротизм: [1-10] + обоснование
-
-💼 **HR-РЕКОМЕНДАЦИИ:**
-- Подходящие роли и позиции
-- Стиль управления/работы
-- Мотивационные факторы
-- Потенциальные риски
-
-🎓 **ОБРАЗОВАТЕЛЬНЫЕ РЕКОМЕНДАЦИИ:**
-- Конкретные направления обучения
-- Форматы обучения (очное/заочное)
-- Дополнительные навыки
-- Карьерная траектория
-
-🔮 **ПРОГНОЗ РАЗВИТИЯ:**
-- Как будет развиваться личность
-- Ключевые точки роста
-- Рекомендации по саморазвитию
-
-СТИЛЬ: Профессиональный, детальный, практичный. 1200-1500 слов.
-"""
-        
-        # Получаем ответ от ИИ
-        ai_response = await self.ai_client.get_response(
-            prompt=prompt,
-            user_id=user_id,
-            prompt_type=PromptType.FULL_ANALYSIS
+        # Получаем ответ от ИИ: инструкции - общий системный префикс
+        return await self.ai_client.get_direct_response(
+            prompt, user_id, system_prompt=_FULL_ANALYSIS_SYSTEM, cache_key='analysis-full'
         )
-        
-        return ai_response.content
     
     async def _send_analysis_result(self, update: Update, result: str):
         """Отправка результата анализа"""
         
-        # Разбиваем длинный результат на части
-        max_length = 4000
-        if len(result) <= max_length:
-            await update.message.reply_text(result, parse_mode=ParseMode.MARKDOWN)
-        else:
-            parts = [result[i:i+max_length] for i in range(0, len(result), max_length)]
-            for i, part in enumerate(parts):
-                prefix = f"**Анализ (часть {i+1}/{len(parts)}):**\n\n" if i > 0 else ""
-                await update.message.reply_text(prefix + part, parse_mode=ParseMode.MARKDOWN)
+        # Разбиваем длинный результат на части по абзацам, чтобы не рвать разметку
+        if len(result) <= 4000:
+            await update.message.reply_text(_to_html(result), parse_mode=_HTML)
+            return
+        
+        chunks = _split_message(result)
+        total = len(chunks)
+        
+        # Части отправляются по очереди: параллельные запросы Telegram может
+        # доставить не по порядку, а анализ читается подряд
+        await update.message.reply_text(_to_html(chunks[0]), parse_mode=_HTML)
+        for i, chunk in enumerate(chunks[1:], 2):
+            await update.message.reply_text(
+                f"<b>Анализ (часть {i}/{total}):</b>\n\n" + _to_html(chunk), parse_mode=_HTML
+            )
     
     def _get_next_question(self, question_num: int) -> str:
         """Получение следующего вопроса теста самооценки (10 вопросов)"""
-        
-        # Упрощенный тест - 10 ключевых вопросов из книги "Восхождение"
-        questions = [
-            "Как вы оцениваете свою ценность как личности? (1-10)",
-            "Насколько вы довольны собой и своими достижениями?",
-            "Верите ли вы в свои способности справляться с трудностями?",
-            "Какие страхи чаще всего мешают вам действовать?",
-            "Как часто вы испытываете гнев или раздражение?",
-            "Есть ли у вас обиды на людей из прошлого?",
-            "Знаете ли вы свое предназначение в жизни?",
-            "Что придает смысл вашей жизни?",
-            "Как вы проявляете любовь к себе?",
-            "Чувствуете ли вы себя свободным быть собой?"
-        ]
-        
-        if question_num < len(questions):
-            progress = f"━" * question_num + "○" + "━" * (10 - question_num - 1)
-            return f"**Вопрос {question_num + 1} из 10:**\n{questions[question_num]}\n\n{progress}"
+        if question_num < len(_SELF_ESTEEM_RENDERED):
+            return _SELF_ESTEEM_RENDERED[question_num]
         
         return "Все вопросы завершены!"
     
@@ -402,203 +712,82 @@ class AnalysisHandler:
     
     async def start_button_test(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Тест самооценки с кнопками"""
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-        
         # Инициализируем данные
-        self.button_test_data[update.effective_user.id] = {
-            'answers': [],
-            'current_question': 0
-        }
+        # Сессия живет в context.user_data: PTB хранит ее per-user и она очищается
+        # вместе с остальными данными пользователя (/cancel, главное меню)
+        context.user_data['button_test'] = TestSession.for_questions('self_esteem_buttons', 10)
         
-        intro_text = """
-📊 **ТЕСТ САМООЦЕНКИ**
-
-Отвечайте на вопросы, нажимая кнопки.
-
-⏱️ **Время:** ~3 минуты
-📊 **Результат:** Детальный анализ с рекомендациями
-
-**Подход:**
-🧠 Психоанализ по авторской методике
-🌟 Духовные принципы самопознания
-💡 Практические упражнения
-
-Начинаем! ⬇️
-"""
-        await update.message.reply_text(intro_text, parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text(_BUTTON_TEST_INTRO, parse_mode=_HTML)
         
         # Показываем первый вопрос
         await self._show_button_question(update, 0)
     
     async def _show_button_question(self, update: Update, question_num: int) -> None:
         """Показать вопрос с кнопками"""
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-        
-        questions_with_buttons = [
-            {
-                'text': "**Вопрос 1/10:**\nКак вы оцениваете свою ценность как личности?",
-                'buttons': [[InlineKeyboardButton(str(i), callback_data=f'btn_test_q0_a{i}') for i in range(1, 6)],
-                           [InlineKeyboardButton(str(i), callback_data=f'btn_test_q0_a{i}') for i in range(6, 11)]]
-            },
-            {
-                'text': "**Вопрос 2/10:**\nНасколько вы довольны собой?",
-                'buttons': [
-                    [InlineKeyboardButton("Очень доволен", callback_data='btn_test_q1_a1')],
-                    [InlineKeyboardButton("Скорее доволен", callback_data='btn_test_q1_a2')],
-                    [InlineKeyboardButton("Не очень", callback_data='btn_test_q1_a3')],
-                    [InlineKeyboardButton("Недоволен", callback_data='btn_test_q1_a4')]
-                ]
-            },
-            {
-                'text': "**Вопрос 3/10:**\nВерите ли в свои способности?",
-                'buttons': [
-                    [InlineKeyboardButton("Полностью верю", callback_data='btn_test_q2_a1')],
-                    [InlineKeyboardButton("Скорее да", callback_data='btn_test_q2_a2')],
-                    [InlineKeyboardButton("Сомневаюсь", callback_data='btn_test_q2_a3')],
-                    [InlineKeyboardButton("Не верю", callback_data='btn_test_q2_a4')]
-                ]
-            },
-            # Остальные вопросы упростим для демо
-            {
-                'text': f"**Вопрос 4/10:**\nКакие страхи мешают вам?",
-                'buttons': [
-                    [InlineKeyboardButton("Страх неудачи", callback_data='btn_test_q3_a1')],
-                    [InlineKeyboardButton("Страх осуждения", callback_data='btn_test_q3_a2')],
-                    [InlineKeyboardButton("Нет сильных страхов", callback_data='btn_test_q3_a3')]
-                ]
-            },
-            {
-                'text': "**Вопрос 5/10:**\nКак часто гнев?",
-                'buttons': [[InlineKeyboardButton(str(i), callback_data=f'btn_test_q4_a{i}') for i in range(1, 6)],
-                           [InlineKeyboardButton(str(i), callback_data=f'btn_test_q4_a{i}') for i in range(6, 11)]]
-            },
-            {
-                'text': "**Вопрос 6/10:**\nЕсть ли обиды?",
-                'buttons': [
-                    [InlineKeyboardButton("Да, много", callback_data='btn_test_q5_a1')],
-                    [InlineKeyboardButton("Есть немного", callback_data='btn_test_q5_a2')],
-                    [InlineKeyboardButton("Почти нет", callback_data='btn_test_q5_a3')],
-                    [InlineKeyboardButton("Нет обид", callback_data='btn_test_q5_a4')]
-                ]
-            },
-            {
-                'text': "**Вопрос 7/10:**\nЗнаете предназначение?",
-                'buttons': [
-                    [InlineKeyboardButton("Да, знаю", callback_data='btn_test_q6_a1')],
-                    [InlineKeyboardButton("Есть идеи", callback_data='btn_test_q6_a2')],
-                    [InlineKeyboardButton("Ищу", callback_data='btn_test_q6_a3')],
-                    [InlineKeyboardButton("Не знаю", callback_data='btn_test_q6_a4')]
-                ]
-            },
-            {
-                'text': "**Вопрос 8/10:**\nЧто придает смысл?",
-                'buttons': [
-                    [InlineKeyboardButton("Семья", callback_data='btn_test_q7_a1')],
-                    [InlineKeyboardButton("Работа", callback_data='btn_test_q7_a2')],
-                    [InlineKeyboardButton("Духовность", callback_data='btn_test_q7_a3')],
-                    [InlineKeyboardButton("Пока не знаю", callback_data='btn_test_q7_a4')]
-                ]
-            },
-            {
-                'text': "**Вопрос 9/10:**\nЛюбовь к себе?",
-                'buttons': [[InlineKeyboardButton(str(i), callback_data=f'btn_test_q8_a{i}') for i in range(1, 6)],
-                           [InlineKeyboardButton(str(i), callback_data=f'btn_test_q8_a{i}') for i in range(6, 11)]]
-            },
-            {
-                'text': "**Вопрос 10/10:**\nСвободны быть собой?",
-                'buttons': [
-                    [InlineKeyboardButton("Да, полностью", callback_data='btn_test_q9_a1')],
-                    [InlineKeyboardButton("В основном да", callback_data='btn_test_q9_a2')],
-                    [InlineKeyboardButton("Не всегда", callback_data='btn_test_q9_a3')],
-                    [InlineKeyboardButton("Нет", callback_data='btn_test_q9_a4')]
-                ]
-            }
-        ]
-        
-        if question_num < len(questions_with_buttons):
-            q = questions_with_buttons[question_num]
-            
-            # Добавляем прогресс бар
-            progress_filled = int((question_num / 10) * 10)
-            progress_bar = "━" * progress_filled + "○" + "━" * (10 - progress_filled - 1)
-            progress_text = f"\n\n{progress_bar}  {question_num}/10 ({progress_filled * 10}%)"
-            
-            # Добавляем кнопки навигации
-            nav_buttons = []
-            if question_num > 0:  # Кнопка "Назад" только если не первый вопрос
-                nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'back_to_q{question_num-1}'))
-            nav_buttons.append(InlineKeyboardButton("❌ Отменить", callback_data='cancel_test'))
-            
-            buttons_with_nav = q['buttons'] + [nav_buttons]
-            reply_markup = InlineKeyboardMarkup(buttons_with_nav)
-            
-            full_text = q['text'] + progress_text
+        if question_num < len(_BUTTON_SCREENS):
+            full_text, reply_markup = _BUTTON_SCREENS[question_num]
             
             if update.callback_query:
                 await update.callback_query.edit_message_text(
                     full_text,
                     reply_markup=reply_markup,
-                    parse_mode=ParseMode.MARKDOWN
+                    parse_mode=_HTML
                 )
             else:
                 await update.message.reply_text(
                     full_text,
                     reply_markup=reply_markup,
-                    parse_mode=ParseMode.MARKDOWN
+                    parse_mode=_HTML
                 )
     
     async def handle_button_test_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработка ответов из кнопок"""
+        # Подтверждение нажатия и смена экрана - независимые запросы к Telegram:
+        # выполняем их параллельно, следующий вопрос появляется на один RTT раньше
+        await asyncio.gather(
+            update.callback_query.answer(),
+            self._handle_button_test_data(update, context)
+        )
+    
+    async def _handle_button_test_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Разбор callback_data теста с кнопками"""
         query = update.callback_query
-        await query.answer()
-        
         user = update.effective_user
         data = query.data
         
         # Проверка на отмену
         if data == 'cancel_test':
-            from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-            
-            keyboard = [
-                [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')],
-                [InlineKeyboardButton("🔄 Начать тест заново", callback_data='test_restart')],
-                [InlineKeyboardButton("💬 Бесплатная консультация (7 вопросов)", callback_data='start_consultation_from_help')],
-                [InlineKeyboardButton("💼 Личная консультация", callback_data='personal')]
-            ]
-            
             await query.edit_message_text(
-                "❌ **ТЕСТ ОТМЕНЕН**\n\n"
+                "❌ <b>ТЕСТ ОТМЕНЕН</b>\n\n"
                 "Ваши ответы не сохранены.\n\n"
                 "Что делать дальше?",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
+                reply_markup=_CANCEL_TEST_MARKUP,
+                parse_mode=_HTML
             )
-            self.button_test_data.pop(user.id, None)
+            context.user_data.pop('button_test', None)
             return
         
         # Обработка запуска консультации из отмены теста
         if data == 'start_consultation_from_help':
             await query.edit_message_text(
-                "💬 **БЕСПЛАТНАЯ КОНСУЛЬТАЦИЯ** (7 вопросов)\n\n"
+                "💬 <b>БЕСПЛАТНАЯ КОНСУЛЬТАЦИЯ</b> (7 вопросов)\n\n"
                 "Отвечайте кратко на каждый вопрос (1-2 предложения).\n\n"
-                "**Принципы:** Книга \"Восхождение\"\n"
-                "**Модель:** GPT-3.5 (экономичная)\n"
-                "**Результат:** Персональные рекомендации\n\n"
-                "**Напишите \"2\" для запуска!**",
-                parse_mode=ParseMode.MARKDOWN
+                "<b>Принципы:</b> Книга \"Восхождение\"\n"
+                "<b>Модель:</b> GPT-3.5 (экономичная)\n"
+                "<b>Результат:</b> Персональные рекомендации\n\n"
+                "<b>Напишите \"2\" для запуска!</b>",
+                parse_mode=_HTML
             )
             return
         
         # Проверка на возврат назад
         if data.startswith('back_to_q'):
-            prev_question = int(data.split('back_to_q')[1])
+            prev_question = int(data[9:])  # back_to_q{N}
             
-            # Удаляем последний ответ
-            if user.id in self.button_test_data:
-                answers = self.button_test_data[user.id]['answers']
-                if len(answers) > prev_question:
-                    self.button_test_data[user.id]['answers'] = answers[:prev_question]
-                    self.button_test_data[user.id]['current_question'] = prev_question
+            # Ответы с prev_question будут перезаписаны при повторном прохождении
+            session = context.user_data.get('button_test')
+            if session is not None:
+                session.current_question = prev_question
             
             # Показываем предыдущий вопрос
             await self._show_button_question(update, prev_question)
@@ -608,16 +797,18 @@ class AnalysisHandler:
         if not data.startswith('btn_test_'):
             return
         
-        parts = data.split('_')
-        question_num = int(parts[2][1:])  # q0 -> 0
-        answer = parts[3]  # a1, a2, etc
+        # Формат фиксирован: номер вопроса - одна цифра после 'btn_test_q'
+        question_num = int(data[10])  # q0 -> 0
+        answer = data[12:]  # a1, a2, etc
         
         # Сохраняем ответ
-        if user.id not in self.button_test_data:
-            self.button_test_data[user.id] = {'answers': [], 'current_question': 0}
+        session = context.user_data.get('button_test')
+        if session is None:
+            session = context.user_data['button_test'] = TestSession.for_questions('self_esteem_buttons', 10)
         
-        self.button_test_data[user.id]['answers'].append(answer)
-        self.button_test_data[user.id]['current_question'] = question_num + 1
+        # Повторное нажатие на тот же вопрос перезаписывает ответ, а не дублирует его
+        session.answers[question_num] = answer
+        session.current_question = question_num + 1
         
         # Проверяем, все ли вопросы отвечены
         if question_num >= 9:  # 10-й вопрос (индекс 9)
@@ -627,108 +818,61 @@ class AnalysisHandler:
                 "⏱️ 30-60 секунд"
             )
             
-            # Показываем typing action
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-            
-            # Анализируем
-            answers = self.button_test_data[user.id]['answers']
-            
-            try:
-                analysis = await self._analyze_self_esteem_simple(user.id, answers)
-                await update.effective_chat.send_message(analysis, parse_mode=ParseMode.MARKDOWN)
-                
-                # Сохраняем в БД
-                await self.database.save_analysis(
-                    user.id,
-                    user.first_name or f"User_{user.id}",
-                    'self_esteem_buttons',
-                    {'answers': answers, 'analysis': analysis}
-                )
-                
-                # FOLLOW-UP: Предлагаем дополнительные вопросы
-                from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-                
-                followup_keyboard = [
-                    [InlineKeyboardButton("💬 Задать вопрос по результату", callback_data='followup_start')],
-                    [InlineKeyboardButton("🔄 Пройти тест заново", callback_data='test_restart')],
-                    [InlineKeyboardButton("👤 Личная консультация", callback_data='personal')],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
-                ]
-                
-                await update.effective_chat.send_message(
-                    "✨ **ЧТО ДАЛЬШЕ?**\n\n"
-                    "У вас есть **10 бесплатных вопросов** по результату теста.\n\n"
-                    "Выберите действие:",
-                    reply_markup=InlineKeyboardMarkup(followup_keyboard),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                
-                # Устанавливаем счетчик вопросов
-                context.user_data['followup_mode'] = True
-                context.user_data['free_questions'] = 10
-                context.user_data['test_result'] = analysis
-                
-            except Exception as e:
-                logger.error(f"Ошибка анализа кнопочного теста: {e}", exc_info=True)
-                await update.effective_chat.send_message(
-                    "😔 Ошибка при анализе. Попробуйте /start"
-                )
+            # Анализ идет в очереди чата, обработчик нажатия сразу освобождается
+            self._submit_to_chat(
+                update.effective_chat.id,
+                # Пропуски возможны, только если сессия создана заново посреди теста
+                self._finish_button_test(update, context, user, [a for a in session.answers if a is not None])
+            )
             
             # Очищаем данные теста
-            self.button_test_data.pop(user.id, None)
+            context.user_data.pop('button_test', None)
         else:
             # Показываем следующий вопрос
             await self._show_button_question(update, question_num + 1)
     
+    async def _finish_button_test(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user, answers: list):
+        """Анализ, отправка и сохранение результата теста с кнопками"""
+        # Показываем typing action
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+        
+        try:
+            analysis = await self._analyze_self_esteem_simple(user.id, answers)
+            
+            # Сохраняем в БД: запись в фоне, и ошибка отправки не теряет анализ
+            self._queue_save(
+                user.id,
+                user.first_name or f"User_{user.id}",
+                'self_esteem_buttons',
+                {'answers': answers, 'analysis': analysis}
+            )
+            
+            await update.effective_chat.send_message(_to_html(analysis), parse_mode=_HTML)
+            
+            # FOLLOW-UP: Предлагаем дополнительные вопросы
+            await update.effective_chat.send_message(
+                "✨ <b>ЧТО ДАЛЬШЕ?</b>\n\n"
+                "У вас есть <b>10 бесплатных вопросов</b> по результату теста.\n\n"
+                "Выберите действие:",
+                reply_markup=_FOLLOWUP_MARKUP,
+                parse_mode=_HTML
+            )
+            
+            # Устанавливаем счетчик вопросов
+            context.user_data['followup_mode'] = True
+            context.user_data['free_questions'] = 10
+            context.user_data['test_result'] = analysis
+            
+        except Exception as e:
+            logger.error(f"Ошибка анализа кнопочного теста: {e}", exc_info=True)
+            await update.effective_chat.send_message(
+                "😔 Ошибка при анализе. Попробуйте /start"
+            )
+    
     async def _analyze_self_esteem_simple(self, user_id: int, answers: list) -> str:
         """Психоаналитический анализ самооценки"""
-        answers_text = "\n".join([f"{i+1}. {ans}" for i, ans in enumerate(answers)])
+        prompt = _answers_prompt(_BUTTONS_PROMPT_HEAD, _NUMBER_LABELS, answers)
         
-        prompt = f"""Проведи психоаналитический анализ самооценки.
-
-ОТВЕТЫ НА ТЕСТ:
-{answers_text}
-
-ИСПОЛЬЗУЙ ИНТЕГРАТИВНЫЙ ПОДХОД:
-
-🧠 **ПСИХОАНАЛИЗ (ФРЕЙД):**
-- Какие защитные механизмы использует человек?
-- Есть ли вытеснение, проекция, рационализация?
-- Как бессознательное влияет на самооценку?
-
-💎 **ЮНГИАНСКИЙ АНАЛИЗ:**
-- Какие архетипы проявляются?
-- Работает ли человек с Тенью (отвергаемыми частями)?
-- На каком этапе индивидуации?
-- Интроверт или экстраверт?
-
-🌟 **ДУХОВНЫЕ АСПЕКТЫ:**
-- Осознает ли свою ценность?
-- Есть ли связь с высшим предназначением?
-- "Для меня создан мир" - принимает ли этот принцип?
-
-ДАЙ АНАЛИЗ (400-500 слов):
-
-📊 **УРОВЕНЬ САМООЦЕНКИ** (1-10 + обоснование)
-
-🧠 **ПСИХОДИНАМИКА**
-[Защитные механизмы, бессознательные паттерны]
-
-💎 **АРХЕТИПИЧЕСКИЙ АНАЛИЗ**
-[Какие архетипы активны, работа с Тенью]
-
-✨ **СИЛЬНЫЕ СТОРОНЫ**
-[На что опираться]
-
-⚠️ **ЗОНЫ РОСТА**
-[Что требует внимания]
-
-🎯 **ПЕРСОНАЛЬНЫЕ РЕКОМЕНДАЦИИ**
-[3-4 конкретных метода: работа с Тенью, диалог с бессознательным, самоанализ]
-
-💡 **ПРАКТИЧЕСКИЕ УПРАЖНЕНИЯ**
-[2-3 упражнения для повышения самооценки]
-
-СТИЛЬ: Глубокий, профессиональный, эмпатичный, мудрый."""
-
-        return await self.ai_client.get_direct_response(prompt, user_id)
\ No newline at end of file
+        return await self.ai_client.get_direct_response(
+            prompt, user_id, system_prompt=_SELF_ESTEEM_BUTTONS_SYSTEM, cache_key='analysis-self-esteem-buttons'
+        )
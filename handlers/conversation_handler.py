@@ -2,9 +2,14 @@
 Обработчик диалогов с интегрированным управлением токенами
 """
 
+import re
+import time
+import asyncio
 import logging
-from typing import Dict, Any, Optional
-from telegram import Update
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, Any, Optional
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 
@@ -13,25 +18,236 @@ from ai.security_manager import SecurityManager
 
 logger = logging.getLogger(__name__)
 
+# Режим разметки без обращения к атрибуту enum на каждой отправке
+_MD = ParseMode.MARKDOWN
+
+# Запросы конкретного анализа в свободном тексте (компилируются один раз)
+_SELF_ESTEEM_RE = re.compile(r'тест самооценки|восхождение', re.IGNORECASE)
+_FULL_ANALYSIS_RE = re.compile(r'полный анализ|детальный анализ', re.IGNORECASE)
+
+# Ключевые слова паттернов речи. Каждая категория - одно регулярное выражение:
+# поиск по альтернативе идет в C за один проход вместо десятков проверок `in`
+_SPEECH_KEYWORDS = {
+    # Психологическая помощь
+    'psychology_need': (
+        'сон', 'сны', 'депрессия', 'тревога', 'стресс', 'паника', 'страх', 
+        'грусть', 'одиночество', 'отношения', 'семья', 'родители', 'дети', 
+        'любовь', 'развод', 'смерть', 'потеря', 'плохо', 'больно', 'страшно'
+    ),
+    # Карьерные вопросы
+    'career_need': (
+        'работа', 'карьера', 'профессия', 'зарплата', 'деньги', 'учеба', 
+        'образование', 'навыки', 'опыт', 'компания', 'начальник', 'коллеги',
+        'высокооплачиваемая работа', 'карьерный рост', 'профессиональное развитие'
+    ),
+    # Эмоциональная поддержка
+    'emotional_support': (
+        'одинок', 'грустно', 'плохо', 'устал', 'устала', 'сложно', 'трудно', 
+        'помоги', 'поддержка', 'понимаю', 'понимаешь'
+    ),
+    # Отмена/прекращение
+    'cancellation': (
+        'не хочу', 'хватит', 'достаточно', 'стоп', 'прекрати', 'остановись', 
+        'не буду', 'не буду говорить', 'не хочу говорить', 'хватит говорить'
+    ),
+    # Смена темы
+    'topic_change': (
+        'другое', 'другая тема', 'давай о', 'поговорим о', 'хочу поговорить о', 
+        'смени тему', 'не об этом'
+    ),
+    # Запрос рассказать о себе
+    'self_introduction_request': (
+        'расскажи о себе', 'расскажи о тебе', 'кто ты', 'что ты', 
+        'как ты работаешь', 'твоя история', 'твоя работа', 'что ты умеешь'
+    ),
+    # Мечты и цели
+    'dream_expression': (
+        'хочу стать', 'мечтаю', 'мечта', 'цель', 'планирую', 'буду', 'стану'
+    ),
+    # Провокационные вопросы
+    'provocative': (
+        'глупый', 'тупой', 'бесполезный', 'не понимаешь', 'не слушаешь', 
+        'плохой', 'ужасный', 'ненавижу', 'ненавидишь', 'не понял', 'не поняла'
+    ),
+}
+_SPEECH_PATTERNS = {
+    name: re.compile('|'.join(map(re.escape, keywords)))
+    for name, keywords in _SPEECH_KEYWORDS.items()
+}
+
+# Ключевые слова для прямых вопросов (одна альтернатива, как у паттернов речи)
+_DIRECT_QUESTION_INDICATORS = (
+    'что из себя представляет',
+    'что входит в',
+    'какие курсы',
+    'расскажи о',
+    'объясни',
+    'что такое',
+    'как работает',
+    'в чем разница',
+    'как выбрать',
+    'где найти',
+    'сколько стоит',
+    'как начать',
+    'с чего начать',
+    'что нужно знать',
+    'какие навыки',
+    'какие требования'
+)
+_DIRECT_QUESTION_RE = re.compile('|'.join(map(re.escape, _DIRECT_QUESTION_INDICATORS)))
+
+# История диалога для промпта: последние 5 сообщений (4 предыдущих и текущее) для экономии
+_HISTORY_SIZE = 5
+
+# Истории хранятся в памяти процесса: не больше 10000 диалогов, и диалог,
+# молчащий дольше часа, начинается с чистого контекста
+_MAX_DIALOGS = 10000
+_HISTORY_TTL = 3600
+
+# Команды структурированной консультации: поиск по хэшу вместо перебора списка
+_CANCEL_WORDS = frozenset({'отмена', 'отменить', 'cancel', 'стоп', 'хватит'})
+_BACK_WORDS = frozenset({'назад', 'back', 'предыдущий'})
+
+# Анализ консультации: постоянные инструкции уходят системным сообщением,
+# ответы склеиваются с готовыми подписями вопросов
+_CONSULTATION_ANALYSIS_SYSTEM = """Ты психолог по книге "Восхождение". 
+
+ЗАДАЧА: Дай краткий анализ (100-150 слов) с 2-3 практическими рекомендациями.
+
+ФОРМАТ:
+💙 Понимание ситуации
+💡 2-3 конкретных совета из книги "Восхождение"
+🎯 Следующий шаг
+
+СТИЛЬ: Поддерживающий, практичный, краткий."""
+_QUESTION_LABELS = tuple(f"Вопрос {i}: " for i in range(1, 16))
+
+# Свободный диалог: инструкции одинаковы для всех пользователей и идут первыми
+_DIALOG_SYSTEM = """Ты — психолог, работающий по принципам книги "Восхождение".
+
+ТВОЙ ПОДХОД:
+
+🌟 **ДУХОВНЫЕ ПРИНЦИПЫ:**
+- "Для меня создан мир" — каждый человек уникально ценен
+- Внутренние силы — корень всех внешних действий
+- Самоуважение через осознание своей истинной ценности
+- У каждого есть предназначение и силы для его выполнения
+- Вера в себя связана с верой в высшее
+
+🔄 **МЕТОДЫ:**
+1. Диалог с душой — разговор с внутренним голосом
+2. Повторение — укоренение позитивных убеждений
+3. Самоанализ — наблюдение за реакциями
+4. Работа с эмоциями — выражение и трансформация чувств
+
+ЗАДАЧА: Помоги человеку понять себя, повысить самооценку, найти предназначение.
+В сообщении пользователя - КОНТЕКСТ разговора и его ВОПРОС.
+
+ОТВЕТ (400-500 слов):
+💙 Эмпатия и понимание
+🧠 Анализ ситуации
+💡 Рекомендации из книги
+🎯 Следующие шаги
+
+СТИЛЬ: Эмпатичный, поддерживающий, мудрый."""
+
+# Вопросы консультации общие для всех: в user_data хранятся только ответы
+# и номер вопроса, и они не пересохраняются целиком на каждом ответе
+_CONSULTATION_QUESTIONS = (
+    "Что вас больше всего беспокоит в себе? (1-2 предложения)",
+    "Какие качества вы хотели бы развить? (1-2 предложения)", 
+    "Что мешает вам чувствовать уверенность? (1-2 предложения)",
+    "Как вы обычно справляетесь со стрессом? (1-2 предложения)",
+    "Что помогает вам чувствовать себя лучше? (1-2 предложения)",
+    "Какие у вас есть мечты или цели? (1-2 предложения)",
+    "Что бы вы хотели изменить в своей жизни? (1-2 предложения)"
+)
+
+# Клавиатуры не меняются между сообщениями и собираются один раз
+_DIALOG_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Завершить", callback_data='end_consultation')],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
+])
+
+_OUT_OF_QUESTIONS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💼 Личная консультация", callback_data='personal')],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
+])
+
+_LIMIT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💼 Личная консультация", callback_data='personal')],
+    [InlineKeyboardButton("📊 Пройти тест", callback_data='test_samoocenka')],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
+])
+
+_MENU_TEST_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')],
+    [InlineKeyboardButton("📊 Тест самооценки", callback_data='test_samoocenka')]
+])
+
+
+def _consultation_markup(current_q: int) -> InlineKeyboardMarkup:
+    """Кнопки навигации для вопроса консультации"""
+    keyboard = []
+    
+    # Кнопка "Назад" только если не первый вопрос
+    if current_q > 0:
+        keyboard.append([InlineKeyboardButton("⬅️ Назад к предыдущему вопросу", callback_data=f'consultation_back_{current_q - 1}')])
+    
+    # Кнопка отмены
+    keyboard.append([InlineKeyboardButton("❌ Отменить консультацию", callback_data='cancel_consultation')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+_CONSULTATION_MARKUPS = tuple(_consultation_markup(i) for i in range(len(_CONSULTATION_QUESTIONS)))
+
 class BotConversationHandler:
     """Обработчик диалогов с умным управлением контекстом"""
     
     def __init__(self, ai_client, database):
         self.ai_client = ai_client
         self.database = database
-        self.conversation_history = {}  # user_id -> list of messages
+        # user_id -> последние сообщения (см. _HISTORY_SIZE); порядок ключей -
+        # от давно активных к недавним, время активности - в _history_seen
+        self.conversation_history: Dict[int, Deque[str]] = {}
+        self._history_seen: Dict[int, float] = {}
         self.free_consultation_tracker = {}  # user_id -> {'count': int, 'max': 7}
         self.security_manager = SecurityManager()  # Менеджер безопасности
     
-    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
-        """Обработка входящих сообщений"""
+    def _touch_history(self, user_id: int) -> Deque[str]:
+        """История пользователя с отметкой активности и вытеснением старых диалогов"""
+        now = time.monotonic()
+        
+        # Переставляем историю в конец словаря: в начале остаются самые давние
+        history = self.conversation_history.pop(user_id, None)
+        if history is None or now - self._history_seen[user_id] > _HISTORY_TTL:
+            history = deque(maxlen=_HISTORY_SIZE)
+        self.conversation_history[user_id] = history
+        self._history_seen[user_id] = now
+        
+        # Вытесняем лишние и неактивные диалоги с начала
+        while True:
+            oldest = next(iter(self.conversation_history))
+            if (len(self.conversation_history) <= _MAX_DIALOGS
+                    and now - self._history_seen[oldest] <= _HISTORY_TTL):
+                break
+            del self.conversation_history[oldest]
+            del self._history_seen[oldest]
+        
+        return history
+    
+    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: Optional[str] = None) -> str:
+        """Обработка входящих сообщений (text - склеенная пачка сообщений, если передана)"""
         user = update.effective_user
-        text = update.message.text.strip()
+        text = (update.message.text if text is None else text).strip()
         
         if not text:
             await update.message.reply_text("Пожалуйста, напишите что-то конкретное.")
             return 'WAITING_MESSAGE'
         
+        # Нижний регистр считается один раз и передается во все проверки
+        text_lower = text.lower()
+        
         # 🔒 ПРОВЕРКИ БЕЗОПАСНОСТИ
         
         # 1. Проверка поведения пользователя
@@ -53,14 +269,7 @@ class BotConversationHandler:
             return 'WAITING_MESSAGE'
         
         # Обработка запроса на консультацию
-        if 'записать' in text.lower() and 'консультац' in text.lower():
-            from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-            
-            keyboard = [
-                [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')],
-                [InlineKeyboardButton("📊 Тест самооценки", callback_data='test_samoocenka')]
-            ]
-            
+        if 'записать' in text_lower and 'консультац' in text_lower:
             await update.message.reply_text(
                 "📝 **ЗАПИСЬ НА КОНСУЛЬТАЦИЮ**\n\n"
                 "Спасибо за интерес!\n\n"
@@ -69,22 +278,22 @@ class BotConversationHandler:
                 "📱 Telegram: @[ваш username]\n"
                 "☎️ Телефон: [укажите номер]\n\n"
                 "🔔 Мы свяжемся с вами в ближайшее время!",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
+                reply_markup=_MENU_TEST_MARKUP,
+                parse_mode=_MD
             )
             return 'WAITING_MESSAGE'
         
         # Обработка команд "1" и "2" (из справки)
-        if text.strip() == "1":
+        if text == "1":
             await update.message.reply_text(
                 "📊 **ТЕСТ САМООЦЕНКИ**\n\n"
                 "Отлично! Запускаю тест с кнопками.\n"
                 "Используйте команду: /test",
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             return 'WAITING_MESSAGE'
             
-        elif text.strip() == "2":
+        elif text == "2":
             # Запуск структурированной консультации
             await self._start_structured_consultation(update, context)
             return 'STRUCTURED_CONSULTATION'
@@ -92,8 +301,7 @@ class BotConversationHandler:
         # Проверяем, находимся ли в режиме структурированной консультации
         if context.user_data.get('consultation_type') == 'structured':
             # Обработка команд отмены и возврата
-            text_lower = text.lower().strip()
-            if text_lower in ['отмена', 'отменить', 'cancel', 'стоп', 'хватит']:
+            if text_lower in _CANCEL_WORDS:
                 context.user_data.clear()
                 await update.message.reply_text(
                     "❌ **КОНСУЛЬТАЦИЯ ОТМЕНЕНА**\n\n"
@@ -102,21 +310,21 @@ class BotConversationHandler:
                     "/start - Главное меню\n"
                     "/test - Тест самооценки\n"
                     "/consultation - Начать консультацию заново",
-                    parse_mode=ParseMode.MARKDOWN
+                    parse_mode=_MD
                 )
                 return 'WAITING_MESSAGE'
             
-            if text_lower in ['назад', 'back', 'предыдущий']:
+            if text_lower in _BACK_WORDS:
                 current_q = context.user_data.get('current_question', 0)
                 if current_q > 0:
                     # Возвращаемся к предыдущему вопросу
                     prev_question = current_q - 1
                     context.user_data['current_question'] = prev_question
                     
-                    # Удаляем последний ответ
-                    answers = context.user_data.get('consultation_answers', [])
-                    if len(answers) > prev_question:
-                        context.user_data['consultation_answers'] = answers[:prev_question]
+                    # Удаляем последний ответ (список меняется на месте)
+                    answers = context.user_data.get('consultation_answers')
+                    if answers:
+                        del answers[prev_question:]
                     
                     await self._ask_consultation_question(update, context)
                     return 'STRUCTURED_CONSULTATION'
@@ -124,11 +332,10 @@ class BotConversationHandler:
                     await update.message.reply_text("Вы на первом вопросе. Отменить консультацию: напишите 'отмена'")
                     return 'STRUCTURED_CONSULTATION'
             
-            return await self._handle_consultation_answer(update, context)
+            return await self._handle_consultation_answer(update, context, text)
         
         # Инициализируем историю пользователя
-        if user.id not in self.conversation_history:
-            self.conversation_history[user.id] = []
+        history = self._touch_history(user.id)
         
         # Инициализируем трекер бесплатной консультации
         if user.id not in self.free_consultation_tracker:
@@ -139,14 +346,6 @@ class BotConversationHandler:
             tracker = self.free_consultation_tracker[user.id]
             if tracker['count'] >= tracker['max']:
                 # Лимит исчерпан
-                from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-                
-                keyboard = [
-                    [InlineKeyboardButton("💼 Личная консультация", callback_data='personal')],
-                    [InlineKeyboardButton("📊 Пройти тест", callback_data='test_samoocenka')],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
-                ]
-                
                 await update.message.reply_text(
                     f"⚠️ **Бесплатная консультация исчерпана ({tracker['count']}/{tracker['max']})**\n\n"
                     f"Хотите продолжить?\n\n"
@@ -155,20 +354,16 @@ class BotConversationHandler:
                     f"• GPT-4 для сложных случаев\n"
                     f"• Кнопка 'Назад' для уточнения\n\n"
                     f"Ориентировочно: от 500₽",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode=ParseMode.MARKDOWN
+                    reply_markup=_LIMIT_MARKUP,
+                    parse_mode=_MD
                 )
                 return 'WAITING_MESSAGE'
         
-        # Добавляем сообщение в историю
-        self.conversation_history[user.id].append(text)
-        
-        # Ограничиваем длину истории
-        if len(self.conversation_history[user.id]) > 20:
-            self.conversation_history[user.id] = self.conversation_history[user.id][-20:]
+        # Добавляем сообщение в историю (deque сам вытесняет старые)
+        history.append(text)
         
         # Анализируем паттерны речи
-        patterns = self._analyze_speech_patterns(text)
+        patterns = self._analyze_speech_patterns(text_lower)
         
         # Обрабатываем специальные случаи
         if patterns['cancellation']:
@@ -181,8 +376,8 @@ class BotConversationHandler:
             return await self._handle_self_introduction(update, context)
         
         # ПРИОРИТЕТ: Если пользователь задает прямой вопрос - отвечаем сразу
-        if self._is_direct_question(text):
-            response_type = self._determine_response_type(patterns, text)
+        if self._is_direct_question(text, text_lower):
+            response_type = self._determine_response_type(patterns, text_lower)
             try:
                 response = await self._get_ai_response(user.id, text, response_type)
                 await self._send_response(update, response)
@@ -195,88 +390,83 @@ class BotConversationHandler:
                 return 'WAITING_MESSAGE'
         
         # Определяем тип ответа
-        response_type = self._determine_response_type(patterns, text)
+        response_type = self._determine_response_type(patterns, text_lower)
         
         # Получаем ответ от ИИ
         try:
-            # Показываем, что бот думает
-            thinking_msg = await update.message.reply_text("🤔 Думаю...")
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+            # Показываем, что бот думает: запросы к Telegram идут параллельно
+            # с запросом к ИИ, а не перед ним
+            thinking_task = asyncio.create_task(update.message.reply_text("🤔 Думаю..."))
+            typing_task = asyncio.create_task(
+                context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+            )
             
-            # Получаем ответ от ИИ (используем GPT-3.5 для бесплатной консультации)
-            response = await self._get_ai_response(user.id, text, response_type)
+            try:
+                # Получаем ответ от ИИ (используем GPT-3.5 для бесплатной консультации)
+                response = await self._get_ai_response(user.id, text, response_type)
+            finally:
+                # Удаляем индикатор и при ошибке ИИ; сбой индикатора не отменяет ответ
+                thinking_msg, _ = await asyncio.gather(thinking_task, typing_task, return_exceptions=True)
+                if isinstance(thinking_msg, Exception):
+                    logger.warning(f"Не удалось показать индикатор ответа: {thinking_msg}")
+                else:
+                    await asyncio.gather(thinking_msg.delete(), return_exceptions=True)
             
             # 4. Проверка лимита токенов (приблизительная оценка)
             estimated_tokens = len(text.split()) * 1.3 + len(response.split()) * 1.3  # Примерная оценка
             is_allowed, reason = self.security_manager.check_token_limit(user.id, int(estimated_tokens))
             if not is_allowed:
-                await thinking_msg.delete()
                 await update.message.reply_text(f"💰 {reason}")
                 return 'WAITING_MESSAGE'
             
-            # Удаляем индикатор
-            await thinking_msg.delete()
-            
-            # Отправляем ответ
-            await self._send_response(update, response)
+            # Счетчик вопросов и кнопки уходят в одном сообщении с ответом,
+            # а не отдельными запросами к Telegram
+            footer = ""
+            reply_markup = None
             
             # Увеличиваем счетчик бесплатной консультации (если не follow-up режим)
             if not context.user_data.get('followup_mode'):
-                self.free_consultation_tracker[user.id]['count'] += 1
-                remaining = self.free_consultation_tracker[user.id]['max'] - self.free_consultation_tracker[user.id]['count']
-                
-                from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+                tracker = self.free_consultation_tracker[user.id]
+                tracker['count'] += 1
+                remaining = tracker['max'] - tracker['count']
                 
-                # Кнопки управления
-                keyboard = [
-                    [InlineKeyboardButton("❌ Завершить", callback_data='end_consultation')],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
-                ]
-                
-                await update.message.reply_text(
-                    f"💡 **Бесплатная консультация:** {self.free_consultation_tracker[user.id]['count']}/{self.free_consultation_tracker[user.id]['max']}\n"
-                    f"Осталось: **{remaining} вопросов**\n"
-                    f"─────────────────",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode=ParseMode.MARKDOWN
+                footer = (
+                    f"\n\n─────────────────\n"
+                    f"💡 **Бесплатная консультация:** {tracker['count']}/{tracker['max']}\n"
+                    f"Осталось: **{remaining} вопросов**"
                 )
+                # Кнопки управления
+                reply_markup = _DIALOG_MARKUP
             
             # PREMIUM FEATURE: Кнопки консультации отключены (функция перенесена в premium_consultation.py)
             
             # FOLLOW-UP РЕЖИМ: Уменьшаем счетчик бесплатных вопросов (после теста)
-            if context.user_data.get('followup_mode'):
+            else:
                 free_q = context.user_data.get('free_questions', 0)
                 if free_q > 0:
                     free_q -= 1
                     context.user_data['free_questions'] = free_q
                     
                     if free_q > 0:
-                        await update.message.reply_text(
-                            f"💡 Осталось бесплатных вопросов: **{free_q}/10**",
-                            parse_mode=ParseMode.MARKDOWN
-                        )
+                        footer = f"\n\n💡 Осталось бесплатных вопросов: **{free_q}/10**"
                     else:
                         # Закончились вопросы - предлагаем платную консультацию
-                        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-                        
-                        keyboard = [
-                            [InlineKeyboardButton("💼 Личная консультация", callback_data='personal')],
-                            [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
-                        ]
-                        
-                        await update.message.reply_text(
+                        footer = (
+                            "\n\n─────────────────\n"
                             "⚠️ **Бесплатные вопросы закончились (10/10)**\n\n"
                             "Хотите продолжить работу?\n\n"
                             "💼 **Личная консультация (в разработке):**\n"
                             "• До 15 вопросов в сессии\n"
                             "• GPT-4 для сложных случаев\n"
                             "• Кнопка 'Назад' для уточнения\n\n"
-                            "Ориентировочно: от 500₽",
-                            reply_markup=InlineKeyboardMarkup(keyboard),
-                            parse_mode=ParseMode.MARKDOWN
+                            "Ориентировочно: от 500₽"
                         )
+                        reply_markup = _OUT_OF_QUESTIONS_MARKUP
                         context.user_data.pop('followup_mode', None)
             
+            # Отправляем ответ
+            await self._send_response(update, response, footer, reply_markup)
+            
         except Exception as e:
             logger.error(f"Ошибка получения ответа ИИ: {e}")
             await update.message.reply_text(
@@ -293,15 +483,6 @@ class BotConversationHandler:
         context.user_data['consultation_type'] = 'structured'
         context.user_data['consultation_answers'] = []
         context.user_data['current_question'] = 0
-        context.user_data['consultation_questions'] = [
-            "Что вас больше всего беспокоит в себе? (1-2 предложения)",
-            "Какие качества вы хотели бы развить? (1-2 предложения)", 
-            "Что мешает вам чувствовать уверенность? (1-2 предложения)",
-            "Как вы обычно справляетесь со стрессом? (1-2 предложения)",
-            "Что помогает вам чувствовать себя лучше? (1-2 предложения)",
-            "Какие у вас есть мечты или цели? (1-2 предложения)",
-            "Что бы вы хотели изменить в своей жизни? (1-2 предложения)"
-        ]
         
         intro_text = """
 💬 **БЕСПЛАТНАЯ КОНСУЛЬТАЦИЯ** (7 вопросов)
@@ -318,17 +499,17 @@ class BotConversationHandler:
         # Проверяем, это callback query или обычное сообщение
         if update.callback_query:
             # Кнопка была нажата - используем edit_message_text
-            await update.callback_query.edit_message_text(intro_text, parse_mode=ParseMode.MARKDOWN)
+            await update.callback_query.edit_message_text(intro_text, parse_mode=_MD)
         else:
             # Обычное сообщение - используем reply_text
-            await update.message.reply_text(intro_text, parse_mode=ParseMode.MARKDOWN)
+            await update.message.reply_text(intro_text, parse_mode=_MD)
         
         await self._ask_consultation_question(update, context)
     
     async def _ask_consultation_question(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Задать вопрос консультации"""
         current_q = context.user_data.get('current_question', 0)
-        questions = context.user_data.get('consultation_questions', [])
+        questions = _CONSULTATION_QUESTIONS
         
         if current_q >= len(questions):
             # Все вопросы заданы - делаем анализ
@@ -338,32 +519,23 @@ class BotConversationHandler:
         question_text = f"**Вопрос {current_q + 1}/7:**\n{questions[current_q]}"
         progress = "🟩" * (current_q + 1) + "⬜" * (len(questions) - current_q - 1)
         
-        # Создаем кнопки для навигации
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-        
-        keyboard = []
-        
-        # Кнопка "Назад" только если не первый вопрос
-        if current_q > 0:
-            keyboard.append([InlineKeyboardButton("⬅️ Назад к предыдущему вопросу", callback_data=f'consultation_back_{current_q - 1}')])
-        
-        # Кнопка отмены
-        keyboard.append([InlineKeyboardButton("❌ Отменить консультацию", callback_data='cancel_consultation')])
+        # Кнопки навигации собраны заранее для каждого вопроса
+        reply_markup = _CONSULTATION_MARKUPS[current_q]
         
         # Проверяем, это callback query или обычное сообщение
         if update.callback_query:
             # Кнопка была нажата - отправляем новое сообщение
             await update.callback_query.message.reply_text(
                 f"{question_text}\n\n{progress}",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
+                reply_markup=reply_markup,
+                parse_mode=_MD
             )
         else:
             # Обычное сообщение - используем reply_text
             await update.message.reply_text(
                 f"{question_text}\n\n{progress}",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
+                reply_markup=reply_markup,
+                parse_mode=_MD
             )
     
     async def _analyze_consultation_answers(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -371,27 +543,18 @@ class BotConversationHandler:
         user = update.effective_user
         answers = context.user_data.get('consultation_answers', [])
         
-        # Формируем краткий анализ
-        analysis_prompt = f"""Ты психолог по книге "Восхождение". 
-
-ОТВЕТЫ ПОЛЬЗОВАТЕЛЯ:
-{chr(10).join([f"Вопрос {i+1}: {answers[i]}" for i in range(len(answers))])}
-
-ЗАДАЧА: Дай краткий анализ (100-150 слов) с 2-3 практическими рекомендациями.
-
-ФОРМАТ:
-💙 Понимание ситуации
-💡 2-3 конкретных совета из книги "Восхождение"
-🎯 Следующий шаг
-
-СТИЛЬ: Поддерживающий, практичный, краткий."""
+        # Формируем краткий анализ: меняются только ответы
+        analysis_prompt = "ОТВЕТЫ ПОЛЬЗОВАТЕЛЯ:\n" + "\n".join(map(str.__add__, _QUESTION_LABELS, answers))
         
         try:
             # Показываем, что бот думает
             thinking_msg = await update.message.reply_text("🤔 Анализирую ваши ответы...")
             
             # Получаем краткий анализ
-            analysis = await self.ai_client.get_direct_response(analysis_prompt, user.id)
+            analysis = await self.ai_client.get_direct_response(
+                analysis_prompt, user.id,
+                system_prompt=_CONSULTATION_ANALYSIS_SYSTEM, cache_key='consultation-analysis'
+            )
             
             # Удаляем индикатор
             await thinking_msg.delete()
@@ -401,36 +564,29 @@ class BotConversationHandler:
                 # Кнопка была нажата - отправляем новое сообщение
                 await update.callback_query.message.reply_text(
                     f"📋 **РЕЗУЛЬТАТ КОНСУЛЬТАЦИИ**\n\n{analysis}",
-                    parse_mode=ParseMode.MARKDOWN
+                    parse_mode=_MD
                 )
             else:
                 # Обычное сообщение - используем reply_text
                 await update.message.reply_text(
                     f"📋 **РЕЗУЛЬТАТ КОНСУЛЬТАЦИИ**\n\n{analysis}",
-                    parse_mode=ParseMode.MARKDOWN
+                    parse_mode=_MD
                 )
             
             # Кнопки завершения
-            from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-            
-            keyboard = [
-                [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')],
-                [InlineKeyboardButton("📊 Тест самооценки", callback_data='test_samoocenka')]
-            ]
-            
             if update.callback_query:
                 # Кнопка была нажата - отправляем новое сообщение
                 await update.callback_query.message.reply_text(
                     "✅ **Консультация завершена!**\n\nЧто делать дальше?",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode=ParseMode.MARKDOWN
+                    reply_markup=_MENU_TEST_MARKUP,
+                    parse_mode=_MD
                 )
             else:
                 # Обычное сообщение - используем reply_text
                 await update.message.reply_text(
                     "✅ **Консультация завершена!**\n\nЧто делать дальше?",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode=ParseMode.MARKDOWN
+                    reply_markup=_MENU_TEST_MARKUP,
+                    parse_mode=_MD
                 )
             
         except Exception as e:
@@ -447,10 +603,10 @@ class BotConversationHandler:
         # Очищаем данные
         context.user_data.clear()
     
-    async def _handle_consultation_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def _handle_consultation_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: Optional[str] = None):
         """Обработка ответа в структурированной консультации"""
         user = update.effective_user
-        text = update.message.text.strip()
+        text = (update.message.text if text is None else text).strip()
         
         if not text:
             await update.message.reply_text("Пожалуйста, напишите ответ на вопрос.")
@@ -463,10 +619,9 @@ class BotConversationHandler:
             )
             return 'STRUCTURED_CONSULTATION'
         
-        # Сохраняем ответ
-        answers = context.user_data.get('consultation_answers', [])
+        # Сохраняем ответ: список уже лежит в user_data, повторная запись не нужна
+        answers = context.user_data.setdefault('consultation_answers', [])
         answers.append(text)
-        context.user_data['consultation_answers'] = answers
         
         # Переходим к следующему вопросу
         current_q = context.user_data.get('current_question', 0)
@@ -475,125 +630,25 @@ class BotConversationHandler:
         await self._ask_consultation_question(update, context)
         return 'STRUCTURED_CONSULTATION'
     
-    def _is_direct_question(self, text: str) -> bool:
+    def _is_direct_question(self, text: str, text_lower: str) -> bool:
         """Определение прямых вопросов, требующих немедленного ответа"""
-        text_lower = text.lower()
-        
-        # Ключевые слова для прямых вопросов
-        direct_question_indicators = [
-            'что из себя представляет',
-            'что входит в',
-            'какие курсы',
-            'расскажи о',
-            'объясни',
-            'что такое',
-            'как работает',
-            'в чем разница',
-            'как выбрать',
-            'где найти',
-            'сколько стоит',
-            'как начать',
-            'с чего начать',
-            'что нужно знать',
-            'какие навыки',
-            'какие требования'
-        ]
-        
-        # Проверяем наличие прямых вопросов
-        for indicator in direct_question_indicators:
-            if indicator in text_lower:
-                return True
-        
-        # Проверяем вопросительные знаки в конце
-        if text.strip().endswith('?'):
-            return True
-        
-        return False
+        # Сначала дешевая проверка вопросительного знака в конце, затем поиск прямых вопросов
+        return text.rstrip().endswith('?') or _DIRECT_QUESTION_RE.search(text_lower) is not None
     
-    def _analyze_speech_patterns(self, text: str) -> Dict[str, bool]:
-        """Анализ паттернов речи"""
-        text_lower = text.lower()
-        
-        patterns = {
-            'psychology_need': False,
-            'career_need': False,
-            'emotional_support': False,
-            'cancellation': False,
-            'topic_change': False,
-            'self_introduction_request': False,
-            'dream_expression': False,
-            'provocative': False
-        }
-        
-        # Психологическая помощь
-        psychology_keywords = [
-            'сон', 'сны', 'депрессия', 'тревога', 'стресс', 'паника', 'страх', 
-            'грусть', 'одиночество', 'отношения', 'семья', 'родители', 'дети', 
-            'любовь', 'развод', 'смерть', 'потеря', 'плохо', 'больно', 'страшно'
-        ]
-        patterns['psychology_need'] = any(keyword in text_lower for keyword in psychology_keywords)
-        
-        # Карьерные вопросы
-        career_keywords = [
-            'работа', 'карьера', 'профессия', 'зарплата', 'деньги', 'учеба', 
-            'образование', 'навыки', 'опыт', 'компания', 'начальник', 'коллеги',
-            'высокооплачиваемая работа', 'карьерный рост', 'профессиональное развитие'
-        ]
-        patterns['career_need'] = any(keyword in text_lower for keyword in career_keywords)
-        
-        # Эмоциональная поддержка
-        emotional_keywords = [
-            'одинок', 'грустно', 'плохо', 'устал', 'устала', 'сложно', 'трудно', 
-            'помоги', 'поддержка', 'понимаю', 'понимаешь'
-        ]
-        patterns['emotional_support'] = any(keyword in text_lower for keyword in emotional_keywords)
-        
-        # Отмена/прекращение
-        cancellation_keywords = [
-            'не хочу', 'хватит', 'достаточно', 'стоп', 'прекрати', 'остановись', 
-            'не буду', 'не буду говорить', 'не хочу говорить', 'хватит говорить'
-        ]
-        patterns['cancellation'] = any(keyword in text_lower for keyword in cancellation_keywords)
-        
-        # Смена темы
-        topic_change_keywords = [
-            'другое', 'другая тема', 'давай о', 'поговорим о', 'хочу поговорить о', 
-            'смени тему', 'не об этом'
-        ]
-        patterns['topic_change'] = any(keyword in text_lower for keyword in topic_change_keywords)
-        
-        # Запрос рассказать о себе
-        self_intro_keywords = [
-            'расскажи о себе', 'расскажи о тебе', 'кто ты', 'что ты', 
-            'как ты работаешь', 'твоя история', 'твоя работа', 'что ты умеешь'
-        ]
-        patterns['self_introduction_request'] = any(keyword in text_lower for keyword in self_intro_keywords)
-        
-        # Мечты и цели
-        dream_keywords = [
-            'хочу стать', 'мечтаю', 'мечта', 'цель', 'планирую', 'буду', 'стану'
-        ]
-        patterns['dream_expression'] = any(keyword in text_lower for keyword in dream_keywords)
-        
-        # Провокационные вопросы
-        provocative_keywords = [
-            'глупый', 'тупой', 'бесполезный', 'не понимаешь', 'не слушаешь', 
-            'плохой', 'ужасный', 'ненавижу', 'ненавидишь', 'не понял', 'не поняла'
-        ]
-        patterns['provocative'] = any(keyword in text_lower for keyword in provocative_keywords)
-        
-        return patterns
+    def _analyze_speech_patterns(self, text_lower: str) -> Dict[str, bool]:
+        """Анализ паттернов речи (текст уже в нижнем регистре)"""
+        return {name: pattern.search(text_lower) is not None for name, pattern in _SPEECH_PATTERNS.items()}
     
-    def _determine_response_type(self, patterns: Dict[str, bool], text: str) -> PromptType:
+    def _determine_response_type(self, patterns: Dict[str, bool], text_lower: str) -> PromptType:
         """Определение типа ответа"""
         
         if patterns['psychology_need'] or patterns['emotional_support']:
             return PromptType.PSYCHOLOGY_CONSULTATION
         elif patterns['career_need']:
             return PromptType.CAREER_CONSULTATION
-        elif 'тест самооценки' in text.lower() or 'восхождение' in text.lower():
+        elif _SELF_ESTEEM_RE.search(text_lower):
             return PromptType.SELF_ESTEEM_ANALYSIS
-        elif 'полный анализ' in text.lower() or 'детальный анализ' in text.lower():
+        elif _FULL_ANALYSIS_RE.search(text_lower):
             return PromptType.FULL_ANALYSIS
         else:
             return PromptType.EXPRESS_ANALYSIS
@@ -601,72 +656,66 @@ class BotConversationHandler:
     async def _get_ai_response(self, user_id: int, message: str, response_type: PromptType) -> str:
         """Получение ответа от ИИ"""
         
-        # Формируем контекст
-        conversation_context = self.conversation_history.get(user_id, [])
-        context = {
-            'conversation': '\n'.join(conversation_context[-5:]),  # Последние 5 сообщений для экономии
-            'user_message': message,
-            'message_count': len(conversation_context)
-        }
-        
-        # Получаем ответ от ИИ (используем GPT-3.5 для бесплатной консультации через прямое обращение)
-        ai_response = await self.ai_client.get_direct_response(
-            prompt=f"""Ты — психолог, работающий по принципам книги "Восхождение".
-
-ТВОЙ ПОДХОД:
-
-🌟 **ДУХОВНЫЕ ПРИНЦИПЫ:**
-- "Для меня создан мир" — каждый человек уникально ценен
-- Внутренние силы — корень всех внешних действий
-- Самоуважение через осознание своей истинной ценности
-- У каждого есть предназначение и силы для его выполнения
-- Вера в себя связана с верой в высшее
-
-🔄 **МЕТОДЫ:**
-1. Диалог с душой — разговор с внутренним голосом
-2. Повторение — укоренение позитивных убеждений
-3. Самоанализ — наблюдение за реакциями
-4. Работа с эмоциями — выражение и трансформация чувств
-
-ЗАДАЧА: Помоги человеку понять себя, повысить самооценку, найти предназначение.
-
-КОНТЕКСТ: {context.get('conversation', '')}
-ВОПРОС: {message}
-
-ОТВЕТ (400-500 слов):
-💙 Эмпатия и понимание
-🧠 Анализ ситуации
-💡 Рекомендации из книги
-🎯 Следующие шаги
-
-СТИЛЬ: Эмпатичный, поддерживающий, мудрый.""",
-            user_id=user_id
+        # Формируем контекст: предыдущие сообщения (текущее уже последнее в истории)
+        history = self.conversation_history.get(user_id, ())
+        conversation = '\n'.join(islice(history, max(len(history) - 1, 0)))
+        
+        # Без контекста промпт не зависит от пользователя: одинаковые вопросы
+        # получают готовый ответ из кэша диалогов (ключ - тип ответа и текст)
+        cache_key = None if conversation else f"dialog_{response_type.value}"
+        
+        # Получаем ответ от ИИ: постоянные инструкции - системным сообщением (общий
+        # кэшируемый префикс), контекст и вопрос пользователя - отдельным сообщением
+        ai_response = await self.ai_client.get_dialog_response(
+            prompt=f"КОНТЕКСТ: {conversation}\nВОПРОС: {message}",
+            user_id=user_id,
+            system_prompt=_DIALOG_SYSTEM,
+            cache_key=cache_key
         )
         
         return ai_response
     
-    async def _send_response(self, update: Update, response: str):
-        """Отправка ответа пользователю с обработкой ошибок"""
+    async def _send_response(self, update: Update, response: str, footer: str = "", reply_markup=None):
+        """Отправка ответа пользователю с обработкой ошибок
+        
+        footer и reply_markup добавляются к последней части ответа.
+        """
         
         try:
-            # Разбиваем длинный ответ на части
-            max_length = 4000
-            if len(response) <= max_length:
-                await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
-            else:
-                parts = [response[i:i+max_length] for i in range(0, len(response), max_length)]
-                for i, part in enumerate(parts):
-                    prefix = f"**Ответ (часть {i+1}/{len(parts)}):**\n\n" if i > 0 else ""
-                    await update.message.reply_text(prefix + part, parse_mode=ParseMode.MARKDOWN)
+            await self._reply_parts(update, response, footer, reply_markup, _MD)
         except Exception as e:
             # Если Markdown не работает, отправляем как обычный текст
             logger.error(f"Ошибка отправки с Markdown: {e}")
             try:
-                await update.message.reply_text(response)
+                await self._reply_parts(update, response, footer.replace("**", ""), reply_markup, None)
             except Exception as e2:
                 logger.error(f"Критическая ошибка отправки сообщения: {e2}")
                 await update.message.reply_text("😔 Извините, произошла ошибка при отправке ответа. Попробуйте еще раз.")
     
+    async def _reply_parts(self, update: Update, response: str, footer: str, reply_markup, parse_mode):
+        """Отправка ответа частями; footer не выводит последнюю часть за лимит Telegram"""
+        
+        # Разбиваем длинный ответ на части
+        max_length = 4000
+        parts = [response[i:i+max_length] for i in range(0, len(response), max_length)] or [response]
+        bold = "**" if parse_mode else ""
+        last = len(parts) - 1
+        for i, part in enumerate(parts):
+            prefix = f"{bold}Ответ (часть {i+1}/{len(parts)}):{bold}\n\n" if i > 0 else ""
+            if i < last:
+                await update.message.reply_text(prefix + part, parse_mode=parse_mode)
+            elif len(prefix) + len(part) + len(footer) <= max_length:
+                await update.message.reply_text(
+                    prefix + part + footer, reply_markup=reply_markup, parse_mode=parse_mode
+                )
+            else:
+                # Не помещается - счетчик и кнопки уходят отдельным сообщением
+                await update.message.reply_text(prefix + part, parse_mode=parse_mode)
+                if footer:
+                    await update.message.reply_text(
+                        footer.lstrip(), reply_markup=reply_markup, parse_mode=parse_mode
+                    )
+    
     async def _suggest_next_steps(self, update: Update, patterns: Dict[str, bool], message_count: int):
         """Предложение следующих шагов"""
         
@@ -694,6 +743,7 @@ class BotConversationHandler:
         user = update.effective_user
         self.ai_client.clear_user_data(user.id)
         self.conversation_history.pop(user.id, None)
+        self._history_seen.pop(user.id, None)
         self.free_consultation_tracker.pop(user.id, None)
         
         return 'END'
@@ -13,6 +13,9 @@ from telegram.constants import ParseMode
 
 logger = logging.getLogger(__name__)
 
+# Режим разметки без обращения к атрибуту enum на каждой отправке
+_MD = ParseMode.MARKDOWN
+
 class MessageHandler:
     """Обработчик основных команд и сообщений"""
     
@@ -56,7 +59,7 @@ class MessageHandler:
         await update.message.reply_text(
             welcome_text, 
             reply_markup=reply_markup,
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=_MD
         )
         return 'WAITING_MESSAGE'
     
@@ -80,7 +83,7 @@ class MessageHandler:
             "• Духовные принципы\n\n"
             "Просто напишите свой вопрос!"
         )
-        await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text(help_text, parse_mode=_MD)
     
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик команды /cancel - работает везде"""
@@ -88,14 +91,10 @@ class MessageHandler:
         
         user = update.effective_user
         
-        # Очищаем ВСЕ данные
+        # Очищаем ВСЕ данные (включая тест с кнопками - он хранится в context.user_data)
         self.ai_client.clear_user_data(user.id)
         context.user_data.clear()
         
-        # Очищаем тест с кнопками если активен
-        if hasattr(self, 'analysis_handler'):
-            self.analysis_handler.button_test_data.pop(user.id, None)
-        
         # Очищаем трекер бесплатной консультации
         if hasattr(self, 'conversation_handler'):
             self.conversation_handler.free_consultation_tracker.pop(user.id, None)
@@ -111,7 +110,7 @@ class MessageHandler:
             "Все данные очищены.\n\n"
             "Что делать дальше?",
             reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=_MD
         )
         return ConversationHandler.END
     
@@ -204,7 +203,7 @@ class MessageHandler:
 💙 Ваша трансформация начинается с первого шага!
 """
         
-        await update.message.reply_text(consultation_text, parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text(consultation_text, parse_mode=_MD)
     
     async def get_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Получение статистики (только для админов)"""
@@ -240,7 +239,7 @@ class MessageHandler:
 {chr(10).join(system_health['token_monitor']['optimization_alerts']) if system_health['token_monitor']['optimization_alerts'] else 'Нет'}
 """
             
-            await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
+            await update.message.reply_text(stats_text, parse_mode=_MD)
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка получения статистики: {e}")
@@ -270,7 +269,7 @@ class MessageHandler:
 • Попаданий: {optimization_status['cache_stats']['hit_rate']:.1%}
 """
             
-            await update.message.reply_text(result_text, parse_mode=ParseMode.MARKDOWN)
+            await update.message.reply_text(result_text, parse_mode=_MD)
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка оптимизации: {e}")
@@ -281,16 +280,19 @@ class MessageHandler:
         from handlers.analysis_handler import AnalysisHandler
         
         query = update.callback_query
-        await query.answer()
-        
         data = query.data
         
         # Проверяем, это кнопки теста, отмена или возврат?
+        # Тест сам подтверждает нажатие (параллельно со сменой вопроса)
         if data.startswith('btn_test_') or data == 'cancel_test' or data.startswith('back_to_q'):
             if hasattr(self, 'analysis_handler'):
                 await self.analysis_handler.handle_button_test_answer(update, context)
+            else:
+                await query.answer()
             return
         
+        await query.answer()
+        
         # Обработка кнопок консультации
         if data == 'cancel_consultation':
             # Отмена консультации
@@ -302,19 +304,19 @@ class MessageHandler:
                 "/start - Главное меню\n"
                 "/test - Тест самооценки\n"
                 "/consultation - Начать консультацию заново",
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             return
         
         if data.startswith('consultation_back_'):
             # Возврат к предыдущему вопросу в консультации
-            prev_question = int(data.split('consultation_back_')[1])
+            prev_question = int(data[18:])  # consultation_back_{N}
             context.user_data['current_question'] = prev_question
             
-            # Удаляем последний ответ
-            answers = context.user_data.get('consultation_answers', [])
-            if len(answers) > prev_question:
-                context.user_data['consultation_answers'] = answers[:prev_question]
+            # Удаляем последний ответ (список меняется на месте)
+            answers = context.user_data.get('consultation_answers')
+            if answers:
+                del answers[prev_question:]
             
             # Показываем предыдущий вопрос
             if hasattr(self, 'conversation_handler'):
@@ -330,7 +332,7 @@ class MessageHandler:
                 "Что делать дальше?\n"
                 "/start - Главное меню\n"
                 "/test - Тест самооценки",
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             return
         
@@ -340,7 +342,7 @@ class MessageHandler:
                 f"💬 **ДОПОЛНИТЕЛЬНЫЕ ВОПРОСЫ**\n\n"
                 f"У вас есть **{context.user_data.get('free_questions', 10)} бесплатных вопросов** по результату теста.\n\n"
                 f"Просто напишите свой вопрос, и я отвечу! 📝",
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             return
         
@@ -353,7 +355,7 @@ class MessageHandler:
             context.user_data.clear()
             await query.edit_message_text(
                 "🏠 Возвращаю вас в главное меню...\n\nИспользуйте: /start",
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             return
             
@@ -363,7 +365,7 @@ class MessageHandler:
                 "📊 **ТЕСТ САМООЦЕНКИ**\n\n"
                 "Отлично! Запускаю тест с кнопками.\n"
                 "Используйте команду: /test",
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             return
             
@@ -379,7 +381,7 @@ class MessageHandler:
                     "**Модель:** GPT-3.5 (экономичная)\n"
                     "**Результат:** Персональные рекомендации\n\n"
                     "**Напишите \"2\" для запуска!**",
-                    parse_mode=ParseMode.MARKDOWN
+                    parse_mode=_MD
                 )
             return
         
@@ -389,7 +391,7 @@ class MessageHandler:
                 "📊 **ТЕСТ САМООЦЕНКИ**\n\n"
                 "Отлично! Запускаю тест с кнопками.\n"
                 "Используйте команду: /test",
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             
         elif data == 'premium':
@@ -412,7 +414,7 @@ class MessageHandler:
 
 /start - Вернуться в меню
 """
-            await query.edit_message_text(premium_text, parse_mode=ParseMode.MARKDOWN)
+            await query.edit_message_text(premium_text, parse_mode=_MD)
             
         elif data == 'personal':
             # Личная консультация (в разработке)
@@ -447,7 +449,7 @@ class MessageHandler:
 
 /start - Вернуться в меню
 """
-            await query.edit_message_text(personal_text, parse_mode=ParseMode.MARKDOWN)
+            await query.edit_message_text(personal_text, parse_mode=_MD)
             
         elif data == 'help':
             # Справка с интерактивными кнопками
@@ -481,5 +483,5 @@ class MessageHandler:
             await query.edit_message_text(
                 help_text,
                 reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
\ No newline at end of file
@@ -38,6 +38,9 @@ from telegram.constants import ParseMode
 
 logger = logging.getLogger(__name__)
 
+# Режим разметки без обращения к атрибуту enum на каждой отправке
+_MD = ParseMode.MARKDOWN
+
 class PremiumConsultationHandler:
     """
     Обработчик платной свободной консультации
@@ -91,7 +94,7 @@ class PremiumConsultationHandler:
 ---
 💎 *Для глубокой работы доступна личная консультация* → /personal
 """
-        await update.message.reply_text(consultation_intro, parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text(consultation_intro, parse_mode=_MD)
         
         # Инициализируем трекер для пользователя
         user_id = update.effective_user.id
@@ -129,7 +132,7 @@ class PremiumConsultationHandler:
                 f"• Глубокий разбор\n\n"
                 f"От 2000₽",
                 reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             return 'WAITING_MESSAGE'
         
@@ -174,7 +177,7 @@ class PremiumConsultationHandler:
                 f"💡 Осталось вопросов: **{remaining}/{tracker['max']}** ({tracker['type']})\n"
                 f"─────────────────",
                 reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=_MD
             )
             
         except Exception as e:
@@ -270,12 +273,12 @@ class PremiumConsultationHandler:
             # Разбиваем длинный ответ на части
             max_length = 4000
             if len(response) <= max_length:
-                await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
+                await update.message.reply_text(response, parse_mode=_MD)
             else:
                 parts = [response[i:i+max_length] for i in range(0, len(response), max_length)]
                 for i, part in enumerate(parts):
                     prefix = f"**Ответ (часть {i+1}/{len(parts)}):**\n\n" if i > 0 else ""
-                    await update.message.reply_text(prefix + part, parse_mode=ParseMode.MARKDOWN)
+                    await update.message.reply_text(prefix + part, parse_mode=_MD)
         except Exception as e:
             # Если Markdown не работает, отправляем как обычный текст
             logger.error(f"Ошибка отправки с Markdown: {e}")
@@ -306,7 +309,7 @@ class PremiumConsultationHandler:
         
         await update.callback_query.edit_message_text(
             f"⬅️ **ПРЕДЫДУЩИЙ ОТВЕТ:**\n\n{prev_response}",
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=_MD
         )
     
     def clear_user_data(self, user_id: int):
@@ -37,6 +37,10 @@ echo "📚 Установка зависимостей..."
 pip install --upgrade pip
 pip install -r requirements.txt
 
+# Предзагрузка словаря tiktoken (первый запрос не ждет скачивания)
+echo "🔤 Предзагрузка tiktoken..."
+python3 scripts/load_tiktoken.py || true
+
 # Создание директорий
 echo "📁 Создание необходимых директорий..."
 mkdir -p logs
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+Предзагрузка BPE-словаря tiktoken при сборке/деплое,
+чтобы первый запрос к боту не ждал скачивания и инициализации энкодера
+"""
+
+import sys
+from pathlib import Path
+
+# Корень проекта в sys.path, чтобы импортировать ai.* при запуске из scripts/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ai.token_manager import get_encoding
+
+
+def main() -> int:
+    encoding = get_encoding("cl100k_base")
+    if encoding is None:
+        print("❌ Не удалось загрузить tiktoken (будет использован примерный подсчет токенов)")
+        return 1
+    
+    print(f"✅ Энкодер {encoding.name} загружен")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())